@@ -0,0 +1 @@
+"""Benchmarks for sigexport, run against synthetic Signal databases."""
@@ -0,0 +1,44 @@
+"""Time fetch_data for a single chat as the database grows.
+
+Run with:
+    python -m benchmarks.bench_chats /tmp/sigexport-bench
+"""
+
+import argparse
+import tempfile
+import time
+from pathlib import Path
+
+from sigexport.data import fetch_data
+
+from .synth import KEY, make_source
+
+
+def main() -> None:
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("root", type=Path, nargs="?")
+    parser.add_argument("--msgs-per-chat", type=int, default=1000)
+    parser.add_argument("--sizes", default="10,100,1000", help="Chat counts")
+    args = parser.parse_args()
+
+    root = args.root or Path(tempfile.mkdtemp(prefix="sigexport-bench-"))
+    print(f"{'chats':>8} {'messages':>10} {'one chat (s)':>14} {'all (s)':>10}")
+    for chats in (int(n) for n in args.sizes.split(",")):
+        src = make_source(root / f"{chats}", chats, args.msgs_per_chat, encrypted=True)
+        db_file = src / "sql" / "db.sqlite"
+
+        start = time.perf_counter()
+        fetch_data(db_file, KEY, chats="Chat0")
+        one = time.perf_counter() - start
+
+        start = time.perf_counter()
+        fetch_data(db_file, KEY)
+        every = time.perf_counter() - start
+
+        total = chats * args.msgs_per_chat
+        print(f"{chats:>8} {total:>10} {one:>14.3f} {every:>10.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""Compare rendering HTML by re-parsing index.md against rendering from records.
+
+The reparse mode is the per-message path create_html used to take: split
+index.md with lines_to_msgs, pick reactions and quotes out with regexes,
+convert with Markdown and patch attachments in with BeautifulSoup.
+Both modes leave out the final page template, which they share.
+
+Run with:
+    python -m benchmarks.bench_html /tmp/sigexport-bench --messages 5000
+"""
+
+import argparse
+import re
+import tempfile
+import time
+from pathlib import Path
+from typing import List
+
+import markdown
+from bs4 import BeautifulSoup
+
+from sigexport import templates
+from sigexport.data import fetch_contacts, iter_convos, open_db
+from sigexport.main import (
+    create_records,
+    fix_names,
+    index_contacts,
+    lines_to_msgs,
+    message_html,
+    message_markdown,
+)
+from sigexport.models import Message
+
+from .synth import KEY, make_source
+
+
+def reparse(lines: List[str]) -> str:
+    """Render lines of Markdown the way create_html did before records."""
+    md = markdown.Markdown()
+    content = ""
+    for date, sender, body in lines_to_msgs(lines):
+        sender = sender[1:-1]
+        date, time = date[1:-1].replace(",", "").split(" ")
+        p = re.compile(r"\(- (.*) -\)")
+        m = p.search(body)
+        reactions = m.groups()[0].replace(",", "") if m else ""
+        body = p.sub("", body)
+        p = re.compile(r">\n> (.*)\n>", flags=re.DOTALL)
+        m = p.search(body)
+        quote = f"<div class=quote>{m.groups()[0]}</div>" if m else ""
+        body = p.sub("", body)
+        body = md.convert(body)
+        body = re.sub(
+            r"(https{0,1}://\S*)", r"<a href='\1' target='_blank'>\1</a> ", body
+        )
+        soup = BeautifulSoup(body, "html.parser")
+        for im in soup.find_all("img"):
+            temp = templates.figure.format(src=im["src"], alt=im["alt"])
+            im.replace_with(BeautifulSoup(temp, "html.parser"))
+        for v in soup.select("a"):
+            if re.search(r'a href=".*\.(m4a|aac)"', str(v)):
+                temp = templates.audio.format(src=v["href"])
+                v.replace_with(BeautifulSoup(temp, "html.parser"))
+        for v in soup.select(r"a[href*=\.mp4]"):
+            temp = templates.video.format(src=v["href"])
+            v.replace_with(BeautifulSoup(temp, "html.parser"))
+        content += templates.message.format(
+            cl="msg me" if sender == "Me" else "msg",
+            date=date,
+            time=time,
+            sender=sender,
+            quote=quote,
+            body=soup,
+            reactions=reactions,
+        )
+    return content
+
+
+def direct(records: List[Message]) -> str:
+    """Render message records with message_html."""
+    md = markdown.Markdown()
+    return "".join(message_html(msg, md) for msg in records)
+
+
+def main() -> None:
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("root", type=Path, nargs="?")
+    parser.add_argument("--messages", type=int, default=5000)
+    args = parser.parse_args()
+
+    root = args.root or Path(tempfile.mkdtemp(prefix="sigexport-bench-"))
+    src = make_source(root / f"html-{args.messages}", 1, args.messages, encrypted=True)
+    with open_db(src / "sql" / "db.sqlite", KEY) as c:
+        contacts, convo_ids = fetch_contacts(c)
+        convos = list(iter_convos(c, contacts, convo_ids))
+    contacts = fix_names(contacts)
+    index = index_contacts(contacts)
+    cid, messages = convos[0]
+    for msg in messages:
+        # normally filled in by copy_attachments
+        msg.setdefault("attachments", [])
+    records = list(create_records(cid, messages, contacts, index, add_quote=True))
+    lines = "\n".join(message_markdown(msg) for msg in records) + "\n"
+
+    print(f"{'mode':>8} {'messages':>10} {'time (s)':>10}")
+    for mode in ("reparse", "direct"):
+        start = time.perf_counter()
+        if mode == "reparse":
+            reparse(lines.splitlines(keepends=True))
+        else:
+            direct(records)
+        elapsed = time.perf_counter() - start
+        print(f"{mode:>8} {len(records):>10} {elapsed:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
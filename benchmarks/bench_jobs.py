@@ -0,0 +1,51 @@
+"""Time a whole export with increasing --jobs.
+
+Run with:
+    python -m benchmarks.bench_jobs /tmp/sigexport-bench --chats 200
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from .synth import make_source
+
+
+def main() -> None:
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("root", type=Path, nargs="?")
+    parser.add_argument("--chats", type=int, default=200)
+    parser.add_argument("--msgs-per-chat", type=int, default=2000)
+    parser.add_argument("--jobs", help="Comma-separated job counts")
+    args = parser.parse_args()
+
+    cpus = os.cpu_count() or 1
+    jobs = [1 << i for i in range(cpus.bit_length()) if 1 << i < cpus] + [cpus]
+    if args.jobs:
+        jobs = [int(n) for n in args.jobs.split(",")]
+
+    root = args.root or Path(tempfile.mkdtemp(prefix="sigexport-bench-"))
+    src = root / f"jobs-{args.chats}x{args.msgs_per_chat}"
+    if not (src / "sql" / "db.sqlite").exists():
+        print(f"Generating {args.chats} chats in {src}")
+        make_source(src, args.chats, args.msgs_per_chat, encrypted=True)
+
+    print(f"{'jobs':>6} {'time (s)':>10} {'speedup':>8}")
+    serial = None
+    for n in jobs:
+        cmd = [sys.executable, "-m", "sigexport.main", f"--source={src}"]
+        cmd += ["--overwrite", f"--jobs={n}", str(root / "out")]
+        start = time.perf_counter()
+        subprocess.run(cmd, check=True, capture_output=True)  # noqa: S603
+        elapsed = time.perf_counter() - start
+        serial = serial or elapsed
+        print(f"{n:>6} {elapsed:>10.1f} {serial / elapsed:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""Compare peak memory of fetch_data against the streaming data layer.
+
+Run with:
+    python -m benchmarks.bench_memory /tmp/sigexport-bench --messages 5000000
+"""
+
+import argparse
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from sigexport.data import fetch_contacts, fetch_data, iter_convos, open_db
+
+from .synth import KEY, make_source
+
+
+def measure(mode: str, db_file: Path) -> None:
+    """Consume every message with the given mode and print time and peak RSS."""
+    start = time.perf_counter()
+    count = 0
+    if mode == "dict":
+        convos, _ = fetch_data(db_file, KEY)
+        for messages in convos.values():
+            count += len(messages)
+    else:
+        with open_db(db_file, KEY) as c:
+            contacts, convo_ids = fetch_contacts(c)
+            for _, messages in iter_convos(c, contacts, convo_ids):
+                count += len(messages)
+    elapsed = time.perf_counter() - start
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    scale = 1 if sys.platform == "darwin" else 1024
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale / 1e6
+    print(f"{mode:>8} {count:>10} {elapsed:>10.1f} {peak:>12.0f}")
+
+
+def main() -> None:
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("root", type=Path, nargs="?")
+    parser.add_argument("--messages", type=int, default=5_000_000)
+    parser.add_argument("--chats", type=int, default=500)
+    parser.add_argument("--measure", choices=("dict", "stream"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        measure(args.measure, args.root / "sql" / "db.sqlite")
+        return
+
+    root = args.root or Path(tempfile.mkdtemp(prefix="sigexport-bench-"))
+    src = root / f"{args.messages}"
+    if not (src / "sql" / "db.sqlite").exists():
+        print(f"Generating {args.messages} messages in {src}")
+        make_source(src, args.chats, args.messages // args.chats, encrypted=True)
+
+    print(f"{'mode':>8} {'messages':>10} {'time (s)':>10} {'peak RSS (MB)':>12}")
+    for mode in ("dict", "stream"):
+        # each mode in a fresh interpreter so peak RSS isn't shared
+        cmd = [sys.executable, "-m", "benchmarks.bench_memory", str(src)]
+        subprocess.run([*cmd, f"--measure={mode}"], check=True)  # noqa: S603
+
+
+if __name__ == "__main__":
+    main()
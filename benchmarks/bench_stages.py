@@ -0,0 +1,145 @@
+"""Time each stage of an export as the number of messages grows.
+
+Each size is exported once, and then again with --old pointing at the
+first export to time merging. The sources are plain SQLite, read with
+--plaintext, unless --encrypted is given. The stage timings from --metrics-file are
+saved as JSON, and can be compared against an earlier run:
+    python -m benchmarks.bench_stages /tmp/sigexport-bench --out new.json \
+        --compare old.json
+
+Run with:
+    python -m benchmarks.bench_stages /tmp/sigexport-bench --sizes 10000,100000
+"""
+
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+from typing import Any, Dict, List
+
+from sigexport import __version__
+
+from .synth import make_source
+
+STAGES = ["fetch", "copy", "markdown", "merge", "html", "total"]
+
+
+def export(src: Path, dest: Path, extra: List[str]) -> Dict[str, Any]:
+    """Run an export and return its metrics."""
+    metrics = dest.with_suffix(".json")
+    cmd = [sys.executable, "-m", "sigexport.main", f"--source={src}"]
+    cmd += ["--overwrite", f"--metrics-file={metrics}", *extra, str(dest)]
+    subprocess.run(cmd, check=True, capture_output=True)  # noqa: S603
+    with metrics.open(encoding="utf-8") as f:
+        data: Dict[str, Any] = json.load(f)
+    stages = {**data["stages"], "total": data["total"]}
+    return {"stages": stages, "chats": len(data["chats"])}
+
+
+def print_run(name: str, messages: int, run: Dict[str, Any]) -> None:
+    """Print the wall time of each stage of a run."""
+    times = [run["stages"].get(s, {}).get("wall", 0.0) for s in STAGES]
+    print(f"{name:<8} {messages:>9} " + " ".join(f"{t:>9.2f}" for t in times))
+
+
+def compare(old: Dict[str, Any], new: Dict[str, Any]) -> None:
+    """Print the ratio of new to old wall time for each stage."""
+    print(f"\nnew / old ({old['version']} -> {new['version']})")
+    old_runs = {(r["name"], r["messages"]): r for r in old["runs"]}
+    for run in new["runs"]:
+        base = old_runs.get((run["name"], run["messages"]))
+        if not base:
+            continue
+        ratios = []
+        for s in STAGES:
+            before = base["stages"].get(s, {}).get("wall", 0.0)
+            after = run["stages"].get(s, {}).get("wall", 0.0)
+            ratios.append(f"{after / before:>9.2f}" if before else f"{'-':>9}")
+        print(f"{run['name']:<8} {run['messages']:>9} " + " ".join(ratios))
+
+
+def main() -> None:
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("root", type=Path, nargs="?")
+    parser.add_argument("--sizes", default="10000,100000,1000000")
+    parser.add_argument("--chats", type=int, default=100)
+    parser.add_argument("--group-ratio", type=float, default=0.3)
+    parser.add_argument("--group-size", type=int, default=8)
+    parser.add_argument("--attachment-ratio", type=float, default=0.02)
+    parser.add_argument("--reaction-ratio", type=float, default=0.1)
+    parser.add_argument("--quote-ratio", type=float, default=0.05)
+    parser.add_argument("--jobs", type=int, default=1)
+    parser.add_argument(
+        "--encrypted", action="store_true", help="Encrypt the sources with SQLCipher"
+    )
+    parser.add_argument("--out", type=Path, help="Where to save the results")
+    parser.add_argument("--compare", type=Path, help="Earlier results to compare")
+    args = parser.parse_args()
+
+    root = args.root or Path(tempfile.mkdtemp(prefix="sigexport-bench-"))
+    params = {
+        "chats": args.chats,
+        "group_ratio": args.group_ratio,
+        "group_size": args.group_size,
+        "attachment_ratio": args.attachment_ratio,
+        "reaction_ratio": args.reaction_ratio,
+        "quote_ratio": args.quote_ratio,
+        "encrypted": args.encrypted,
+    }
+    results: Dict[str, Any] = {
+        "version": __version__,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "jobs": args.jobs,
+        "params": params,
+        "runs": [],
+    }
+
+    print(f"{'run':<8} {'messages':>9} " + " ".join(f"{s:>9}" for s in STAGES))
+    for messages in (int(n) for n in args.sizes.split(",")):
+        tag = "-".join(str(v) for v in params.values())
+        src = root / f"stages-{messages}-{tag}"
+        if not (src / "sql" / "db.sqlite").exists():
+            print(f"Generating {messages} messages in {src}")
+            make_source(
+                src,
+                args.chats,
+                messages // args.chats,
+                group_ratio=args.group_ratio,
+                group_size=args.group_size,
+                attachment_ratio=args.attachment_ratio,
+                reaction_ratio=args.reaction_ratio,
+                quote_ratio=args.quote_ratio,
+                encrypted=args.encrypted,
+            )
+        opts = [f"--jobs={args.jobs}"]
+        if not args.encrypted:
+            opts.append("--plaintext")
+        first = root / f"out-{messages}"
+        runs = {
+            "export": export(src, first, opts),
+            "merge": export(
+                src, root / f"out-{messages}-merged", [*opts, f"--old={first}"]
+            ),
+        }
+        for name, run in runs.items():
+            print_run(name, messages, run)
+            results["runs"].append({"name": name, "messages": messages, **run})
+
+    if args.out:
+        with args.out.open("w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+        print(f"\nSaved results to {args.out}")
+    if args.compare:
+        with args.compare.open(encoding="utf-8") as f:
+            compare(json.load(f), results)
+
+
+if __name__ == "__main__":
+    main()
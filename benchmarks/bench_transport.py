@@ -0,0 +1,89 @@
+"""Compare plain and gzipped transport of --print-data output.
+
+The extractor is run locally, as it would be inside the container, and
+its output is read back the way the host reads it from Docker.
+
+Run with:
+    python -m benchmarks.bench_transport /tmp/sigexport-bench --messages 200000
+"""
+
+import argparse
+import io
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import IO, Any, cast
+
+from sigexport.transport import (
+    COMPRESS_ENV,
+    Compression,
+    iter_records,
+    open_input,
+    read_header,
+)
+
+from .synth import make_source
+
+
+class CountingReader(io.RawIOBase):
+    """Count the bytes read from a pipe."""
+
+    def __init__(self, raw: IO[bytes]) -> None:
+        """Wrap raw."""
+        self.raw = raw
+        self.count = 0
+
+    def readable(self) -> bool:
+        """Can be read."""
+        return True
+
+    def readinto(self, b: Any) -> int:  # noqa: ANN401
+        """Read from the pipe, counting what was read."""
+        data = self.raw.read(len(b))
+        b[: len(data)] = data
+        self.count += len(data)
+        return len(data)
+
+
+def main() -> None:
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("root", type=Path, nargs="?")
+    parser.add_argument("--messages", type=int, default=200_000)
+    parser.add_argument("--chats", type=int, default=100)
+    args = parser.parse_args()
+
+    root = args.root or Path(tempfile.mkdtemp(prefix="sigexport-bench-"))
+    src = root / f"{args.messages}"
+    if not (src / "sql" / "db.sqlite").exists():
+        print(f"Generating {args.messages} messages in {src}")
+        make_source(src, args.chats, args.messages // args.chats, encrypted=True)
+
+    print(f"{'transport':>10} {'messages':>10} {'MB':>8} {'time (s)':>10}")
+    for compression in Compression:
+        env = {**os.environ, COMPRESS_ENV: compression.value}
+        cmd = [sys.executable, "-m", "sigexport.main", f"--source={src}"]
+        start = time.perf_counter()
+        p = subprocess.Popen(  # noqa: S603
+            [*cmd, "--print-data"],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            env=env,
+        )
+        assert p.stdout  # noqa: S101
+        # unbuffered, so reads return whatever is in the pipe
+        counter = CountingReader(p.stdout.raw)  # type: ignore[attr-defined]
+        data = open_input(io.BufferedReader(cast(Any, counter)))
+        read_header(data.readline())
+        count = sum(len(messages) for _, messages in iter_records(data))
+        p.wait()
+        elapsed = time.perf_counter() - start
+        mb = counter.count / 1e6
+        print(f"{compression.value:>10} {count:>10} {mb:>8.1f} {elapsed:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
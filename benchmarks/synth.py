@@ -0,0 +1,188 @@
+"""Generate synthetic Signal source directories."""
+
+import json
+import random
+import sqlite3
+from pathlib import Path
+from typing import Any, Dict
+
+KEY = "a" * 64
+
+CONVERSATIONS = """
+CREATE TABLE conversations(
+id STRING PRIMARY KEY,
+json TEXT,
+active_at INT,
+type STRING,
+members TEXT,
+name TEXT,
+profileName TEXT,
+profileFamilyName TEXT,
+profileFullName TEXT,
+e164 TEXT,
+uuid TEXT,
+groupId TEXT,
+profileLastFetchedAt INT
+)
+"""
+
+MESSAGES = """
+CREATE TABLE messages(
+rowid INTEGER PRIMARY KEY,
+id STRING,
+json TEXT,
+sent_at INTEGER,
+conversationId STRING,
+source STRING,
+type STRING,
+body TEXT
+)
+"""
+
+INDEX = "CREATE INDEX messages_conversation ON messages (conversationId, sent_at)"
+
+START = 1_500_000_000_000
+
+WORDS = ("hello", "there", "how", "are", "you", "fine", "https://signal.org")
+EMOJI = ("👍", "❤️", "😂", "😮", "😢")
+ATTACHMENT_TYPES = (
+    ("jpg", "image/jpeg"),
+    ("png", "image/png"),
+    ("mp4", "video/mp4"),
+    ("aac", "audio/aac"),
+    ("pdf", "application/pdf"),
+)
+
+
+def connect(db_file: Path, encrypted: bool) -> sqlite3.Connection:
+    """Create db_file, encrypted with KEY as Signal does if encrypted is set."""
+    if not encrypted:
+        return sqlite3.connect(str(db_file))
+
+    from pysqlcipher3 import dbapi2 as sqlcipher  # type: ignore[import]
+
+    db = sqlcipher.connect(str(db_file))
+    c = db.cursor()
+    c.execute(f"PRAGMA KEY = \"x'{KEY}'\"")
+    c.execute("PRAGMA cipher_page_size = 4096")
+    c.execute("PRAGMA kdf_iter = 64000")
+    c.execute("PRAGMA cipher_hmac_algorithm = HMAC_SHA512")
+    c.execute("PRAGMA cipher_kdf_algorithm = PBKDF2_HMAC_SHA512")
+    return db  # type: ignore[no-any-return]
+
+
+def make_attachment(
+    rng: random.Random, att_dir: Path, name: str, size: int
+) -> Dict[str, Any]:
+    """Write a random attachment file and return its message JSON."""
+    ext, content_type = rng.choice(ATTACHMENT_TYPES)
+    path = f"{name[:2]}/{name}"
+    (att_dir / name[:2]).mkdir(exist_ok=True)
+    (att_dir / path).write_bytes(rng.getrandbits(size * 8).to_bytes(size, "little"))
+    return {
+        "path": path,
+        "fileName": f"{name}.{ext}",
+        "contentType": content_type,
+        "size": size,
+    }
+
+
+def make_source(
+    root: Path,
+    chats: int,
+    msgs_per_chat: int,
+    seed: int = 0,
+    group_ratio: float = 0.0,
+    group_size: int = 5,
+    attachment_ratio: float = 0.0,
+    attachment_size: int = 4096,
+    reaction_ratio: float = 0.0,
+    quote_ratio: float = 0.0,
+    encrypted: bool = False,
+) -> Path:
+    """Write config.json, sql/db.sqlite and attachments.noindex under root.
+
+    group_ratio of the chats are groups with group_size members, who are
+    added as contacts without messages of their own. attachment_ratio,
+    reaction_ratio and quote_ratio are the fractions of messages with an
+    attachment, reactions or a quote of the previous message.
+
+    Without encrypted, the DB is plain SQLite, which sigexport reads with
+    --plaintext, so it can be benchmarked without SQLCipher.
+    """
+    rng = random.Random(seed)  # noqa: S311
+    root.mkdir(parents=True, exist_ok=True)
+    att_dir = root / "attachments.noindex"
+    att_dir.mkdir(exist_ok=True)
+    (root / "config.json").write_text(json.dumps({"key": KEY}))
+    db_file = root / "sql" / "db.sqlite"
+    db_file.parent.mkdir(exist_ok=True)
+    if db_file.exists():
+        db_file.unlink()
+
+    db = connect(db_file, encrypted)
+    c = db.cursor()
+    c.execute(CONVERSATIONS)
+    c.execute(MESSAGES)
+    c.execute(INDEX)
+
+    groups = int(chats * group_ratio)
+    members = [(f"member-{k:05}", f"+1666{k:07}") for k in range(group_size * 4)]
+    if groups:
+        c.executemany(
+            "INSERT INTO conversations (id, type, name, e164) VALUES (?, ?, ?, ?)",
+            [(mid, "private", f"Member{k}", n) for k, (mid, n) in enumerate(members)],
+        )
+
+    for i in range(chats):
+        cid = f"convo-{i:05}"
+        if i < groups:
+            chat_members = rng.sample(members, min(group_size, len(members)))
+            c.execute(
+                "INSERT INTO conversations (id, type, name, members) "
+                "VALUES (?, ?, ?, ?)",
+                (cid, "group", f"Group{i}", " ".join(m for m, _ in chat_members)),
+            )
+        else:
+            chat_members = [(cid, f"+1555{i:07}")]
+            c.execute(
+                "INSERT INTO conversations (id, type, name, e164) VALUES (?, ?, ?, ?)",
+                (cid, "private", f"Chat{i}", chat_members[0][1]),
+            )
+        rows = []
+        body = ""
+        for j in range(msgs_per_chat):
+            sent_at = START + j * 60_000 + rng.randrange(60_000)
+            outgoing = rng.random() < 0.5
+            prev_body = body
+            body = " ".join(rng.choice(WORDS) for _ in range(rng.randrange(1, 20)))
+            msg: Dict[str, Any] = {
+                "id": f"{cid}-{j}",
+                "conversationId": cid,
+                "type": "outgoing" if outgoing else "incoming",
+                "source": None if outgoing else rng.choice(chat_members)[1],
+                "sent_at": sent_at,
+                "timestamp": sent_at,
+                "body": body,
+            }
+            if rng.random() < attachment_ratio:
+                name = f"{i:05}{j:08}"
+                msg["attachments"] = [
+                    make_attachment(rng, att_dir, name, attachment_size)
+                ]
+            if rng.random() < reaction_ratio:
+                reactors = rng.sample(chat_members, rng.randint(1, len(chat_members)))
+                msg["reactions"] = [
+                    {"fromId": mid, "emoji": rng.choice(EMOJI)} for mid, _ in reactors
+                ]
+            if j and rng.random() < quote_ratio:
+                msg["quote"] = {"id": sent_at - 60_000, "text": prev_body}
+            rows.append((msg["id"], json.dumps(msg), sent_at, cid, msg["type"]))
+        c.executemany(
+            "INSERT INTO messages (id, json, sent_at, conversationId, type) "
+            "VALUES (?, ?, ?, ?, ?)",
+            rows,
+        )
+    db.commit()
+    db.close()
+    return root
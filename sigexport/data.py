@@ -2,60 +2,146 @@
 
 import json
 import os
+import shutil
 import sqlite3
+import subprocess
+import tempfile
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from itertools import groupby
+from operator import itemgetter
 from pathlib import Path
-from typing import Optional, Tuple
+from typing import DefaultDict, Dict, Iterator, List, Optional, Tuple
 
-from pysqlcipher3 import dbapi2 as sqlcipher  # type: ignore[import]
-from typer import secho
+from typer import Exit, colors, secho
 
-from .models import Contacts, Convos
+from .files import secure_delete
+from .models import ChatStats, Contacts, Convo, Convos, ConvoStream
 
 
-def fetch_data(
+def default_decrypt_dir(db_file: Path) -> Path:
+    """Pick where to decrypt to: tmpfs if the DB fits there, else the temp dir."""
+    shm = Path("/dev/shm")  # noqa: S108
+    if shm.is_dir() and os.access(shm, os.W_OK):
+        if shutil.disk_usage(shm).free > 2 * db_file.stat().st_size:
+            return shm
+    return Path(tempfile.gettempdir())
+
+
+def decrypt(db_file: Path, key: str, out: Path, log: bool = False) -> None:
+    """Decrypt db_file to out with the sqlcipher CLI, feeding it SQL on stdin."""
+    target = str(out).replace("'", "''")
+    script = (
+        f"PRAGMA key = \"x'{key}'\";\n"
+        f"ATTACH DATABASE '{target}' AS plaintext KEY '';\n"
+        "SELECT sqlcipher_export('plaintext');\n"
+        "DETACH DATABASE plaintext;\n"
+    )
+    if log:
+        secho(f"Manually decrypting db to {out}")
+    start = time.perf_counter()
+    try:
+        p = subprocess.run(  # noqa: S603
+            ["sqlcipher", "-bail", str(db_file)],  # noqa: S607
+            input=script,
+            capture_output=True,
+            text=True,
+        )
+    except FileNotFoundError:
+        secho("Error: --manual needs the sqlcipher command, is it installed?")
+        raise Exit(1)
+    if p.returncode or not out.is_file():
+        secho("Manual decryption failed, see output below:", fg=colors.RED)
+        secho(p.stdout)
+        secho(p.stderr, fg=colors.RED)
+        raise Exit(1)
+    secho(f"Decrypted db in {time.perf_counter() - start:.1f}s")
+
+
+@contextmanager
+def open_db(
     db_file: Path,
-    key: str,
+    key: Optional[str],
     manual: bool = False,
-    chats: Optional[str] = None,
-    include_empty: bool = False,
     log: bool = False,
-) -> Tuple[Convos, Contacts]:
-    """Load SQLite data into dicts."""
+    decrypt_dir: Optional[Path] = None,
+) -> Iterator[sqlite3.Cursor]:
+    """Open the Signal DB and yield a cursor, cleaning up afterwards.
+
+    With no key, db_file is a plaintext copy and is opened with sqlite3, so
+    SQLCipher isn't needed. With manual, the DB is decrypted with the
+    sqlcipher CLI into a temporary directory in decrypt_dir, which is
+    deleted again on exit.
+    """
+    tmp: Optional[Path] = None
+    try:
+        if key is None:
+            db = sqlite3.connect(str(db_file))
+            c = db.cursor()
+        elif manual:
+            tmp = Path(
+                tempfile.mkdtemp(
+                    prefix="sigexport-", dir=decrypt_dir or default_decrypt_dir(db_file)
+                )
+            )
+            decrypt(db_file, key, tmp / "db.sqlite", log=log)
+            # use sqlite instead of sqlcipher as DB already decrypted
+            db = sqlite3.connect(str(tmp / "db.sqlite"))
+            c = db.cursor()
+        else:
+            from pysqlcipher3 import dbapi2 as sqlcipher  # type: ignore[import]
+
+            db = sqlcipher.connect(str(db_file))
+            c = db.cursor()
+            # param binding doesn't work for pragmas, so use a direct string concat
+            c.execute(f"PRAGMA KEY = \"x'{key}'\"")
+            c.execute("PRAGMA cipher_page_size = 4096")
+            c.execute("PRAGMA kdf_iter = 64000")
+            c.execute("PRAGMA cipher_hmac_algorithm = HMAC_SHA512")
+            c.execute("PRAGMA cipher_kdf_algorithm = PBKDF2_HMAC_SHA512")
+
+        try:
+            yield c
+        finally:
+            db.close()
+    finally:
+        if tmp:
+            for f in tmp.iterdir():
+                secure_delete(f)
+            tmp.rmdir()
+
+
+def export_plaintext(c: sqlite3.Cursor, path: Path, manual: bool = False) -> None:
+    """Write a decrypted copy of the open DB to path."""
+    if path.exists():
+        path.unlink()
+    if manual:
+        # already reading a decrypted copy
+        c.execute("VACUUM INTO ?", (str(path),))
+    else:
+        c.execute("ATTACH DATABASE ? AS plaintext KEY ''", (str(path),))
+        c.execute("SELECT sqlcipher_export('plaintext')")
+        c.execute("DETACH DATABASE plaintext")
+
+
+def fetch_contacts(
+    c: sqlite3.Cursor, chats: Optional[str] = None, log: bool = False
+) -> Tuple[Contacts, Optional[List[str]]]:
+    """Load contacts, and the ids of the conversations selected by chats."""
     contacts: Contacts = {}
-    convos: Convos = {}
+    convo_ids: Optional[List[str]] = None
     if chats:
         chats_list = chats.split(",")
+        convo_ids = []
 
-    db_file_decrypted = db_file.parents[0] / "db-decrypt.sqlite"
-    if manual:
-        if log:
-            secho(f"Manually decrypting db to {db_file_decrypted}")
-        if db_file_decrypted.exists():
-            db_file_decrypted.unlink()
-        command = (
-            f'echo "'
-            f"PRAGMA key = \\\"x'{key}'\\\";"
-            f"ATTACH DATABASE '{db_file_decrypted}' AS plaintext KEY '';"
-            f"SELECT sqlcipher_export('plaintext');"
-            f"DETACH DATABASE plaintext;"
-            f'" | sqlcipher {db_file}'
-        )
-        os.system(command)
-        # use sqlite instead of sqlcipher as DB already decrypted
-        db = sqlite3.connect(str(db_file_decrypted))
-        c = db.cursor()
-    else:
-        db = sqlcipher.connect(str(db_file))
-        c = db.cursor()
-        # param binding doesn't work for pragmas, so use a direct string concat
-        c.execute(f"PRAGMA KEY = \"x'{key}'\"")
-        c.execute("PRAGMA cipher_page_size = 4096")
-        c.execute("PRAGMA kdf_iter = 64000")
-        c.execute("PRAGMA cipher_hmac_algorithm = HMAC_SHA512")
-        c.execute("PRAGMA cipher_kdf_algorithm = PBKDF2_HMAC_SHA512")
-
-    query = "SELECT type, id, e164, name, profileName, members FROM conversations"
-    c.execute(query)
+    # newer Signal versions renamed uuid to serviceId
+    c.execute("PRAGMA table_info(conversations)")
+    columns = {row[1] for row in c}
+    uuid = next((col for col in ("serviceId", "uuid") if col in columns), "NULL")
+
+    query = "SELECT type, id, e164, name, profileName, members, {} FROM conversations"
+    c.execute(query.format(uuid))
     for result in c:
         if log:
             secho(f"\tLoading SQL results for: {result[3]}, aka {result[4]}")
@@ -66,25 +152,166 @@ def fetch_data(
             "name": result[3],
             "number": result[2],
             "profileName": result[4],
+            "uuid": result[6],
             "is_group": is_group,
         }
         if contacts[cid]["name"] is None:
             contacts[cid]["name"] = contacts[cid]["profileName"]
 
-        if not chats or (result[3] in chats_list or result[4] in chats_list):
-            convos[cid] = []
+        if convo_ids is not None and (
+            result[3] in chats_list or result[4] in chats_list
+        ):
+            convo_ids.append(cid)
+
+    return contacts, convo_ids
 
-    c.execute("SELECT json, conversationId FROM messages ORDER BY sent_at")
-    for result in c:
-        content = json.loads(result[0])
-        cid = result[1]
-        if cid and cid in convos:
-            convos[cid].append(content)
 
-    if db_file_decrypted.exists():
-        db_file_decrypted.unlink()
+def fetch_chat_stats(c: sqlite3.Cursor) -> ChatStats:
+    """Count messages and find the first and last sent_at for each conversation.
 
-    if not include_empty:
-        convos = {key: val for key, val in convos.items() if len(val) > 0}
+    This is a single aggregate query, so no message JSON is loaded.
+    """
+    c.execute(
+        "SELECT conversationId, COUNT(*), MIN(sent_at), MAX(sent_at) "
+        "FROM messages GROUP BY conversationId"
+    )
+    return {cid: (count, first, last) for cid, count, first, last in c if cid}
 
+
+def fetch_last_rowid(c: sqlite3.Cursor) -> int:
+    """Get the rowid of the last message added, or 0 if there are none."""
+    c.execute("SELECT MAX(rowid) FROM messages")
+    row = c.fetchone()
+    return (row[0] or 0) if row else 0
+
+
+def iter_messages(
+    c: sqlite3.Cursor,
+    convo_ids: Optional[List[str]] = None,
+    batch_size: int = 1000,
+    after: int = 0,
+    until: Optional[int] = None,
+) -> Iterator[Tuple[str, Convo]]:
+    """Yield (conversationId, message) ordered by conversation and sent_at.
+
+    Rows are pulled from the cursor batch_size at a time, so only one batch
+    is held in memory. If convo_ids is given, only those conversations are
+    queried (and decrypted and parsed), and with after, only messages added
+    after that rowid. With until, messages added after that rowid are left
+    out, so ones added during an export aren't exported again next time.
+    """
+    query = "SELECT conversationId, json FROM messages"
+    conditions: List[str] = []
+    params: List[object] = []
+    if convo_ids is not None:
+        params += convo_ids
+        placeholders = ",".join("?" * len(convo_ids))
+        conditions.append(f"conversationId IN ({placeholders})")
+    if after:
+        params.append(after)
+        conditions.append("rowid > ?")
+    if until is not None:
+        params.append(until)
+        conditions.append("rowid <= ?")
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    c.execute(query + " ORDER BY conversationId, sent_at, rowid", params)
+    while True:
+        rows = c.fetchmany(batch_size)
+        if not rows:
+            return
+        for cid, content in rows:
+            if cid:
+                yield cid, json.loads(content)
+
+
+def iter_convos(
+    c: sqlite3.Cursor,
+    contacts: Contacts,
+    convo_ids: Optional[List[str]] = None,
+    include_empty: bool = False,
+    largest_first: bool = False,
+    until: Optional[int] = None,
+) -> ConvoStream:
+    """Yield (conversationId, messages) one conversation at a time.
+
+    With largest_first, conversations come in descending order of message
+    count, each with its own query, so the slowest ones can start first.
+    until is passed on to iter_messages.
+    """
+    selected = set(contacts if convo_ids is None else convo_ids)
+    seen = set()
+    if largest_first:
+        stats = fetch_chat_stats(c)
+        ids = sorted(
+            (cid for cid in stats if cid in selected), key=lambda cid: -stats[cid][0]
+        )
+        for cid in ids:
+            seen.add(cid)
+            yield cid, [msg for _, msg in iter_messages(c, [cid], until=until)]
+    else:
+        for cid, rows in groupby(
+            iter_messages(c, convo_ids, until=until), key=itemgetter(0)
+        ):
+            if cid in selected:
+                seen.add(cid)
+                yield cid, [msg for _, msg in rows]
+
+    if include_empty:
+        for cid in contacts:
+            if cid in selected and cid not in seen:
+                yield cid, []
+
+
+def iter_new_convos(
+    c: sqlite3.Cursor,
+    contacts: Contacts,
+    since: Dict[str, int],
+    default: int = 0,
+    convo_ids: Optional[List[str]] = None,
+    include_empty: bool = False,
+    until: Optional[int] = None,
+) -> ConvoStream:
+    """Yield (conversationId, messages) with only the messages added since.
+
+    since maps conversation ids to the rowid of the last message already
+    exported from them, and any other conversation uses default. Most share
+    the same rowid, so they're read with one query over the newest messages.
+    Messages added after until are left out.
+    """
+    selected = set(contacts if convo_ids is None else convo_ids)
+    others: DefaultDict[int, List[str]] = defaultdict(list)
+    for cid, rowid in since.items():
+        if cid in selected and rowid != default:
+            others[rowid].append(cid)
+    skip = {cid for ids in others.values() for cid in ids}
+
+    seen = set()
+    queries = [(convo_ids, default, skip)]
+    queries += [(ids, rowid, set()) for rowid, ids in sorted(others.items())]
+    for ids, after, exclude in queries:
+        messages = iter_messages(c, ids, after=after, until=until)
+        for cid, rows in groupby(messages, key=itemgetter(0)):
+            if cid in selected and cid not in exclude:
+                seen.add(cid)
+                yield cid, [msg for _, msg in rows]
+
+    if include_empty:
+        for cid in contacts:
+            if cid in selected and cid not in seen:
+                yield cid, []
+
+
+def fetch_data(
+    db_file: Path,
+    key: str,
+    manual: bool = False,
+    chats: Optional[str] = None,
+    include_empty: bool = False,
+    log: bool = False,
+) -> Tuple[Convos, Contacts]:
+    """Load SQLite data into dicts."""
+    with open_db(db_file, key, manual=manual, log=log) as c:
+        contacts, convo_ids = fetch_contacts(c, chats=chats, log=log)
+        convos = dict(iter_convos(c, contacts, convo_ids, include_empty))
     return convos, contacts
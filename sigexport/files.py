@@ -0,0 +1,362 @@
+"""Write output files."""
+
+import errno
+import hashlib
+import os
+import shutil
+import threading
+from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from enum import Enum
+from pathlib import Path
+from types import TracebackType
+from typing import IO, DefaultDict, Dict, Iterable, List, Optional, Set, Tuple, Type
+
+from typer import colors, secho
+
+BUFFER_SIZE = 1 << 20
+
+
+def write_lines(
+    lines: Iterable[Tuple[Path, str]], buffer_size: int = BUFFER_SIZE
+) -> None:
+    """Write each line to its file, keeping the file open while it repeats.
+
+    Lines for the same file are expected to be consecutive (as they are from
+    create_markdown), so each file is opened (and truncated) once and
+    written through a buffer of buffer_size bytes.
+    """
+    current: Optional[Path] = None
+    f: Optional[IO[str]] = None
+    try:
+        for path, text in lines:
+            if path != current:
+                if f:
+                    f.close()
+                f = path.open("w", encoding="utf-8", buffering=buffer_size)
+                current = path
+            assert f  # noqa: S101
+            f.write(text)
+            f.write("\n")
+    finally:
+        if f:
+            f.close()
+
+
+def write_chunks(
+    path: Path,
+    chunks: Iterable[str],
+    buffer_size: int = BUFFER_SIZE,
+    append: bool = False,
+) -> None:
+    """Write chunks of text to path as they're produced, or add them to it."""
+    with path.open(
+        "a" if append else "w", encoding="utf-8", buffering=buffer_size
+    ) as f:
+        for chunk in chunks:
+            f.write(chunk)
+
+
+class LinkMode(str, Enum):
+    """How attachments are put into the output directory."""
+
+    copy = "copy"
+    hardlink = "hardlink"
+    reflink = "reflink"
+    symlink = "symlink"
+
+
+class StoreKey(str, Enum):
+    """How files in the shared media store are named."""
+
+    path = "path"
+    hash = "hash"
+
+
+# directory in the output holding the shared media store
+MEDIA_STORE = "_media"
+
+# from linux/fs.h
+FICLONE = 0x40049409
+
+# errors from a link the filesystem can't make, so a copy is made instead
+LINK_UNSUPPORTED = {errno.EXDEV, errno.EPERM, errno.EOPNOTSUPP, errno.ENOTSUP}
+
+COPIED = "copied"
+LINKED = "linked"
+SKIPPED = "skipped"
+
+
+def reflink(src: Path, dst: Path) -> None:
+    """Make dst a copy-on-write clone of src (Btrfs, XFS and similar)."""
+    try:
+        import fcntl
+    except ImportError:
+        raise OSError(errno.EOPNOTSUPP, "reflinks not supported", str(dst))
+    with src.open("rb") as s, dst.open("wb") as d:
+        fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+    shutil.copystat(src, dst)
+
+
+def file_hash(path: Path) -> str:
+    """Get the SHA-256 of a file's contents."""
+    h = hashlib.sha256()
+    with path.open("rb") as f:
+        for chunk in iter(lambda: f.read(BUFFER_SIZE), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def is_unchanged(
+    src: Path, dst: Path, mode: LinkMode = LinkMode.copy, compare_hash: bool = False
+) -> bool:
+    """Check whether dst already holds src, as transferring it with mode would.
+
+    Symlinks have to point at src and hardlinks be the same file, so a copy
+    left by an earlier export is linked instead, unless it's on another
+    device where it can't be. Copies (and reflinks) match on size and
+    mtime, which copy2 preserves, or on a hash of their contents if
+    compare_hash is set.
+    """
+    if not os.path.lexists(dst):
+        return False
+    if mode == LinkMode.symlink or dst.is_symlink():
+        return (
+            mode == LinkMode.symlink
+            and dst.is_symlink()
+            and dst.resolve() == src.resolve()
+        )
+    src_stat, dst_stat = src.stat(), dst.stat()
+    if os.path.samestat(src_stat, dst_stat):
+        return mode == LinkMode.hardlink
+    if mode == LinkMode.hardlink and src_stat.st_dev == dst_stat.st_dev:
+        return False
+    if src_stat.st_size != dst_stat.st_size:
+        return False
+    if compare_hash:
+        return file_hash(src) == file_hash(dst)
+    return int(src_stat.st_mtime) == int(dst_stat.st_mtime)
+
+
+def transfer(
+    src: Path,
+    dst: Path,
+    mode: LinkMode = LinkMode.copy,
+    skip_unchanged: bool = False,
+    compare_hash: bool = False,
+) -> Tuple[str, int]:
+    """Put src at dst, returning what was done and the bytes written.
+
+    Links are made under a temporary name and moved over dst, so they
+    replace what an earlier export left there. If the filesystem can't make
+    one (eg across devices) a copy is made instead.
+    """
+    size = src.stat().st_size  # raises FileNotFoundError before linking
+    if skip_unchanged and is_unchanged(src, dst, mode, compare_hash):
+        return SKIPPED, 0
+
+    if mode != LinkMode.copy:
+        tmp = dst.with_name(f".{dst.name}.{threading.get_ident()}.tmp")
+        try:
+            if mode == LinkMode.hardlink:
+                os.link(src, tmp)
+            elif mode == LinkMode.symlink:
+                os.symlink(src.absolute(), tmp)
+            else:
+                reflink(src, tmp)
+            os.replace(tmp, dst)
+            return LINKED, 0
+        except OSError as e:
+            if e.errno not in LINK_UNSUPPORTED:
+                raise
+        finally:
+            # left behind if it failed, or if dst was already a hardlink to src
+            if os.path.lexists(tmp):
+                tmp.unlink()
+
+    # never copy through a link left by a previous export into the source
+    if dst.is_symlink() or (dst.exists() and dst.samefile(src)):
+        dst.unlink()
+    shutil.copy2(src, dst)
+    return COPIED, size
+
+
+def secure_delete(path: Path) -> None:
+    """Overwrite a file with zeros and flush it to disk before deleting it.
+
+    This is best effort: SSDs and copy-on-write filesystems may keep the old
+    blocks around.
+    """
+    size = path.stat().st_size
+    zeros = bytes(min(size, BUFFER_SIZE))
+    with path.open("r+b") as f:
+        written = 0
+        while written < size:
+            written += f.write(zeros[: size - written])
+        f.flush()
+        os.fsync(f.fileno())
+    path.unlink()
+
+
+def link_to_store(stored: Path, dst: Path) -> None:
+    """Point dst at a file in the media store with a relative link.
+
+    Falls back to a hardlink and then a copy where symlinks aren't allowed.
+    """
+    target = os.path.relpath(stored, dst.parent)
+    if dst.is_symlink() and os.readlink(dst) == target:
+        return
+    if os.path.lexists(dst):
+        dst.unlink()
+    try:
+        os.symlink(target, dst)
+    except OSError:
+        try:
+            os.link(stored, dst)
+        except OSError:
+            shutil.copy2(stored, dst)
+
+
+@dataclass
+class CopyStats:
+    """Outcome of copying attachments."""
+
+    copied: int = 0
+    linked: int = 0
+    skipped: int = 0
+    bytes_written: int = 0
+    # bytes written for each chat, as passed to Copier.copy
+    chat_bytes: DefaultDict[str, int] = field(default_factory=lambda: defaultdict(int))
+    missing: List[Path] = field(default_factory=list)
+    errors: List[Tuple[Path, str]] = field(default_factory=list)
+
+    def summary(self) -> str:
+        """Describe the counts in one line."""
+        return (
+            f"{self.copied} copied, {self.linked} linked, {self.skipped} skipped, "
+            f"{len(self.missing)} missing, {self.bytes_written / 1e6:.1f} MB written"
+        )
+
+    def add(self, outcome: str, size: int, chat: str = "") -> None:
+        """Count one file, copied for chat."""
+        if outcome == COPIED:
+            self.copied += 1
+        elif outcome == LINKED:
+            self.linked += 1
+        else:
+            self.skipped += 1
+        self.bytes_written += size
+        if size:
+            self.chat_bytes[chat] += size
+
+
+class Copier:
+    """Copy files in the background on a pool of jobs threads.
+
+    This lets the caller render chats while their attachments are copied,
+    as copying mostly waits on the disk without holding the GIL. At most
+    jobs * 64 copies are queued at once, so submitting blocks when the disk
+    falls behind instead of queueing the whole export in memory. Results
+    are collected on the calling thread. With jobs = 0, files are copied on
+    the calling thread instead.
+    """
+
+    def __init__(
+        self,
+        jobs: int = 1,
+        mode: LinkMode = LinkMode.copy,
+        skip_unchanged: bool = False,
+        compare_hash: bool = False,
+        store: Optional[Path] = None,
+        store_key: StoreKey = StoreKey.path,
+    ) -> None:
+        """Start the pool.
+
+        If store is given, each file is put there once under a key and the
+        destinations become relative links to it.
+        """
+        self.mode = mode
+        self.skip_unchanged = skip_unchanged
+        self.compare_hash = compare_hash
+        self.store = store
+        self.store_key = store_key
+        self.stats = CopyStats()
+        self._executor = ThreadPoolExecutor(jobs) if jobs > 0 else None
+        self._max_pending = jobs * 64
+        self._pending: Dict[Future[Tuple[str, int]], Tuple[Path, str]] = {}
+        self._locks: Dict[Path, threading.Lock] = defaultdict(threading.Lock)
+        self._locks_lock = threading.Lock()
+        if store:
+            store.mkdir(parents=True, exist_ok=True)
+
+    def copy(self, src: Path, dst: Path, chat: str = "") -> None:
+        """Copy src to dst, or queue it to be copied.
+
+        The bytes written are counted towards chat in the stats.
+        """
+        if not self._executor:
+            try:
+                self.stats.add(*self._transfer(src, dst), chat)
+            except OSError as e:
+                self._failed(src, e)
+            return
+
+        if len(self._pending) >= self._max_pending:
+            done, _ = wait(self._pending, return_when=FIRST_COMPLETED)
+            self._collect(done)
+        future = self._executor.submit(self._transfer, src, dst)
+        self._pending[future] = src, chat
+
+    def _transfer(self, src: Path, dst: Path) -> Tuple[str, int]:
+        if not self.store:
+            return transfer(src, dst, self.mode, self.skip_unchanged, self.compare_hash)
+
+        key = file_hash(src) if self.store_key == StoreKey.hash else src.name
+        stored = self.store / f"{key}{dst.suffix}"
+        # the same attachment can be forwarded to chats handled on other threads
+        with self._locks_lock:
+            lock = self._locks[stored]
+        with lock:
+            if self.store_key == StoreKey.hash and stored.exists():
+                result = SKIPPED, 0
+            else:
+                result = transfer(src, stored, self.mode, True, self.compare_hash)
+        link_to_store(stored, dst)
+        return result
+
+    def close(self) -> CopyStats:
+        """Wait for queued copies to finish."""
+        if self._executor:
+            self._collect(set(self._pending))
+            self._executor.shutdown()
+        return self.stats
+
+    def __enter__(self) -> "Copier":
+        """Use as a context manager that waits for all copies on exit."""
+        return self
+
+    def __exit__(
+        self,
+        exc_type: Optional[Type[BaseException]],
+        exc: Optional[BaseException],
+        tb: Optional[TracebackType],
+    ) -> None:
+        """Wait for queued copies to finish."""
+        self.close()
+
+    def _collect(self, done: Set["Future[Tuple[str, int]]"]) -> None:
+        for future in done:
+            src, chat = self._pending.pop(future)
+            try:
+                self.stats.add(*future.result(), chat)
+            except OSError as e:
+                self._failed(src, e)
+
+    def _failed(self, src: Path, e: OSError) -> None:
+        if isinstance(e, FileNotFoundError):
+            secho(f"No file to copy at {src}, skipping!", fg=colors.MAGENTA)
+            self.stats.missing.append(src)
+        else:
+            secho(f"Failed to copy {src}: {e}", fg=colors.RED)
+            self.stats.errors.append((src, str(e)))
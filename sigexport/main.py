@@ -1,26 +1,105 @@
 """Main script for sigexport."""
 
+import io
 import json
 import os
 import re
 import shutil
 import subprocess
 import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import ExitStack, contextmanager, redirect_stdout
 from datetime import datetime
+from itertools import chain, islice
 from pathlib import Path
-from typing import Iterable, List, Optional, Tuple
+from typing import (
+    IO,
+    Callable,
+    DefaultDict,
+    Deque,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    NoReturn,
+    Optional,
+    Set,
+    Tuple,
+)
 
 import emoji
 import markdown
-from bs4 import BeautifulSoup  # type: ignore[import]
 from typer import Argument, Exit, Option, colors, run, secho
 
 from sigexport import __version__, templates
-from sigexport.models import Contacts, Convos
+from sigexport.data import (
+    default_decrypt_dir,
+    export_plaintext,
+    fetch_chat_stats,
+    fetch_contacts,
+    fetch_last_rowid,
+    iter_convos,
+    iter_new_convos,
+    open_db,
+)
+from sigexport.files import (
+    BUFFER_SIZE,
+    MEDIA_STORE,
+    Copier,
+    LinkMode,
+    StoreKey,
+    secure_delete,
+    write_chunks,
+    write_lines,
+)
+from sigexport.manifest import LAST_PAGE, ChatState, LastPage, Manifest
+from sigexport.metrics import Metrics, Stats, timed
+from sigexport.models import (
+    ChatStats,
+    ContactIndex,
+    Contacts,
+    Convo,
+    ConvoStream,
+    Message,
+)
+from sigexport.pool import Pool, cpu_count
+from sigexport.pretty import indent_html
+from sigexport.profiling import profile_worker, profiled
+from sigexport.transport import (
+    COMPRESS_ENV,
+    Compression,
+    iter_records,
+    open_input,
+    open_output,
+    read_header,
+    write_records,
+)
 
 log = False
 
-DATA_DELIM = "-----DATA-----"
+# contacts for the worker processes, set by init_worker
+worker_contacts: Contacts = {}
+worker_index: ContactIndex = {}
+
+IMAGE_EXTS = ["png", "jpg", "jpeg", "gif", "tif", "tiff"]
+# where a group message's sender can be, oldest first
+SENDER_KEYS = ("source", "sourceServiceId", "sourceUuid")
+
+# the parts of a message in markdown, as written by message_markdown
+MESSAGE_MD = re.compile(r"^(\[\d{4}-\d{2}-\d{2},{0,1} \d{2}:\d{2}\])(.*?:)(.*\n)")
+REACTIONS_MD = re.compile(r"\n\(- (.*) -\)$")
+ATTACHMENT_MD = re.compile(r"!?\[([^\]\n]*)\]\(\./media/[^)\s]*\)  ")
+ATTACHMENTS_MD = re.compile(r"(?:!?\[[^\]\n]*\]\(\./media/[^)\s]*\)  )+$")
+QUOTE_MD = re.compile(r"\n>\n> (.*)\n>\n", flags=re.DOTALL)
+LINK = re.compile(r"(https{0,1}://\S*)")
+# private-use code points around an attachment's index, which markdown leaves
+# alone (and which are escaped where they're typed in a message)
+ATTACHMENT_MARK = "\ue000{}\ue001"
+ATTACHMENT_HTML = re.compile(r"\ue000(\d+)\ue001")
+LINK_HTML = r"<a href='\1' target='_blank'>\1</a> "
 
 
 def version_callback(value: bool) -> None:
@@ -49,62 +128,59 @@ def source_location() -> Path:
 
 
 def copy_attachments(
-    src: Path, dest: Path, convos: Convos, contacts: Contacts
+    src: Path, dest: Path, key: str, messages: List[Convo], contacts: Contacts
 ) -> Iterable[Tuple[Path, Path]]:
     """Copy attachments and reorganise in destination directory."""
     src_att = Path(src) / "attachments.noindex"
     dest = Path(dest)
 
-    for key, messages in convos.items():
-        name = contacts[key]["name"]
-        if log:
-            secho(f"\tCopying attachments for: {name}")
-        # some contact names are None
-        if not name:
-            name = "None"
-        contact_path = dest / name / "media"
-        contact_path.mkdir(exist_ok=True, parents=True)
-        for msg in messages:
-            if "attachments" in msg and msg["attachments"]:
-                attachments = msg["attachments"]
-                date = (
-                    datetime.fromtimestamp(msg["timestamp"] / 1000.0)
-                    .isoformat(timespec="milliseconds")
-                    .replace(":", "-")
-                )
-                for i, att in enumerate(attachments):
-                    try:
-                        # Account for no fileName key
-                        file_name = (
-                            str(att["fileName"]) if "fileName" in att else "None"
-                        )
-                        # Sometimes the key is there but it is None, needs extension
-                        if "." not in file_name:
-                            content_type = att["contentType"].split("/")
-                            try:
-                                ext = content_type[1]
-                            except IndexError:
-                                ext = content_type[0]
-                            file_name += "." + ext
-                        att["fileName"] = (
-                            f"{date}_{i:02}_{file_name}".replace(" ", "_")
-                            .replace("/", "-")
-                            .replace(",", "")
-                            .replace(":", "-")
-                        )
-                        # account for erroneous backslash in path
-                        att_path = str(att["path"]).replace("\\", "/")
-                        yield src_att / att_path, contact_path / att["fileName"]
-                    except KeyError:
-                        if log:
-                            p = att["path"] if "path" in att else ""
-                            secho(f"\t\tBroken attachment:\t{name}\t{p}")
-                    except FileNotFoundError:
-                        if log:
-                            p = att["path"] if "path" in att else ""
-                            secho(f"\t\tAttachment not found:\t{name}\t{p}")
-            else:
-                msg["attachments"] = []
+    name = contacts[key]["name"]
+    if log:
+        secho(f"\tCopying attachments for: {name}")
+    # some contact names are None
+    if not name:
+        name = "None"
+    contact_path = dest / name / "media"
+    contact_path.mkdir(exist_ok=True, parents=True)
+    for msg in messages:
+        if "attachments" in msg and msg["attachments"]:
+            attachments = msg["attachments"]
+            date = (
+                datetime.fromtimestamp(msg["timestamp"] / 1000.0)
+                .isoformat(timespec="milliseconds")
+                .replace(":", "-")
+            )
+            for i, att in enumerate(attachments):
+                try:
+                    # Account for no fileName key
+                    file_name = str(att["fileName"]) if "fileName" in att else "None"
+                    # Sometimes the key is there but it is None, needs extension
+                    if "." not in file_name:
+                        content_type = att["contentType"].split("/")
+                        try:
+                            ext = content_type[1]
+                        except IndexError:
+                            ext = content_type[0]
+                        file_name += "." + ext
+                    att["fileName"] = (
+                        f"{date}_{i:02}_{file_name}".replace(" ", "_")
+                        .replace("/", "-")
+                        .replace(",", "")
+                        .replace(":", "-")
+                    )
+                    # account for erroneous backslash in path
+                    att_path = str(att["path"]).replace("\\", "/")
+                    yield src_att / att_path, contact_path / att["fileName"]
+                except KeyError:
+                    if log:
+                        p = att["path"] if "path" in att else ""
+                        secho(f"\t\tBroken attachment:\t{name}\t{p}")
+                except FileNotFoundError:
+                    if log:
+                        p = att["path"] if "path" in att else ""
+                        secho(f"\t\tAttachment not found:\t{name}\t{p}")
+        else:
+            msg["attachments"] = []
 
 
 def timestamp_format(ts: float) -> str:
@@ -112,116 +188,182 @@ def timestamp_format(ts: float) -> str:
     return datetime.fromtimestamp(ts / 1000.0).strftime("%Y-%m-%d %H:%M")
 
 
-def create_markdown(
-    dest: Path, convos: Convos, contacts: Contacts, add_quote: bool = False
-) -> Iterable[Tuple[Path, str]]:
-    """Output each conversation into a simple text file."""
-    dest = Path(dest)
-    for key, messages in convos.items():
-        name = contacts[key]["name"]
-        if log:
-            secho(f"\tDoing markdown for: {name}")
-        is_group = contacts[key]["is_group"]
-        # some contact names are None
-        if not name:
-            name = "None"
-        md_path = dest / name / "index.md"
-        with md_path.open("w", encoding="utf-8") as _:
-            pass  # overwrite file if it exists
-
-        for msg in messages:
+def chat_name(contacts: Contacts, key: str) -> str:
+    """Get the output directory name for a conversation."""
+    # some contact names are None
+    return contacts[key]["name"] or "None"
+
+
+def sender_id(msg: Convo, index: ContactIndex) -> str:
+    """Find the conversation id of a group message's sender.
+
+    Older messages have the sender's number in source, and newer ones a
+    UUID in sourceServiceId or sourceUuid, so each is tried in turn.
+    Raises KeyError if none of them is a known contact.
+    """
+    for key in SENDER_KEYS:
+        if msg.get(key) in index:
+            return index[msg[key]]
+    raise KeyError("no known sender")
+
+
+def create_records(
+    key: str,
+    messages: List[Convo],
+    contacts: Contacts,
+    index: ContactIndex,
+    add_quote: bool = False,
+) -> Iterable[Message]:
+    """Turn a conversation's raw messages into records for output."""
+    name = chat_name(contacts, key)
+    is_group = contacts[key]["is_group"]
+
+    for msg in messages:
+        try:
+            date = timestamp_format(msg["sent_at"])
+        except (KeyError, TypeError):
             try:
                 date = timestamp_format(msg["sent_at"])
             except (KeyError, TypeError):
-                try:
-                    date = timestamp_format(msg["sent_at"])
-                except (KeyError, TypeError):
-                    date = "1970-01-01 00:00"
-                    if log:
-                        secho("\t\tNo timestamp or sent_at; date set to 1970")
+                date = "1970-01-01 00:00"
+                if log:
+                    secho("\t\tNo timestamp or sent_at; date set to 1970")
 
-            if log:
-                secho(f"\t\tDoing {name}, msg: {date}")
+        if log:
+            secho(f"\t\tDoing {name}, msg: {date}")
 
+        try:
+            if msg["type"] == "call-history":
+                body = (
+                    "Incoming call"
+                    if msg["callHistoryDetails"]["wasIncoming"]
+                    else "Outgoing call"
+                )
+            else:
+                body = msg["body"]
+        except KeyError:
+            if log:
+                secho(f"\t\tNo body:\t\t{date}")
+            body = ""
+        if not body:
+            body = ""
+        body = body.replace("`", "")  # stop md code sections forming
+        body += "  "  # so that markdown newlines
+
+        sender = "No-Sender"
+        if "type" in msg.keys() and msg["type"] == "outgoing":
+            sender = "Me"
+        else:
             try:
-                if msg["type"] == "call-history":
-                    body = (
-                        "Incoming call"
-                        if msg["callHistoryDetails"]["wasIncoming"]
-                        else "Outgoing call"
-                    )
+                if is_group:
+                    sender = contacts[sender_id(msg, index)]["name"]
                 else:
-                    body = msg["body"]
+                    sender = contacts[msg["conversationId"]]["name"]
             except KeyError:
                 if log:
-                    secho(f"\t\tNo body:\t\t{date}")
-                body = ""
-            if not body:
-                body = ""
-            body = body.replace("`", "")  # stop md code sections forming
-            body += "  "  # so that markdown newlines
-
-            sender = "No-Sender"
-            if "type" in msg.keys() and msg["type"] == "outgoing":
-                sender = "Me"
-            else:
+                    secho(f"\t\tNo sender:\t\t{date}")
+
+        attachments = [att["fileName"] for att in msg["attachments"]]
+
+        reactions: Optional[List[str]] = None
+        if "reactions" in msg and msg["reactions"]:
+            reactions = []
+            for r in msg["reactions"]:
                 try:
-                    if is_group:
-                        for c in contacts.values():
-                            num = c["number"]
-                            if num is not None and num == msg["source"]:
-                                sender = c["name"]
-                    else:
-                        sender = contacts[msg["conversationId"]]["name"]
+                    from_id = index[r["fromId"]]
+                    reactions.append(f"{contacts[from_id]['name']}: {r['emoji']}")
                 except KeyError:
                     if log:
-                        secho(f"\t\tNo sender:\t\t{date}")
-
-            for att in msg["attachments"]:
-                file_name = att["fileName"]
-                path = Path("media") / file_name
-                path = Path(str(path).replace(" ", "%20"))
-                if path.suffix and path.suffix.split(".")[1] in [
-                    "png",
-                    "jpg",
-                    "jpeg",
-                    "gif",
-                    "tif",
-                    "tiff",
-                ]:
-                    body += "!"
-                body += f"[{file_name}](./{path})  "
-
-            if "reactions" in msg and msg["reactions"]:
-                reactions = []
-                for r in msg["reactions"]:
-                    try:
-                        reactions.append(
-                            f"{contacts[r['fromId']]['name']}: {r['emoji']}"
+                        secho(
+                            f"\t\tReaction fromId not found in contacts: "
+                            f"[{date}] {sender}: {r}"
                         )
-                    except KeyError:
-                        if log:
-                            secho(
-                                f"\t\tReaction fromId not found in contacts: "
-                                f"[{date}] {sender}: {r}"
-                            )
-                body += "\n(- " + ", ".join(reactions) + " -)"
 
-            if "sticker" in msg and msg["sticker"]:
-                try:
-                    body = msg["sticker"]["data"]["emoji"]
-                except KeyError:
-                    pass
+        if "sticker" in msg and msg["sticker"]:
+            try:
+                body = msg["sticker"]["data"]["emoji"]
+                attachments, reactions = [], None
+            except KeyError:
+                pass
+
+        quote = None
+        if add_quote:
+            try:
+                quote = f"{msg['quote']['text']}"
+            except (KeyError, TypeError):
+                pass
+
+        yield Message(date, sender, body, quote, reactions, attachments)
 
-            quote = ""
-            if add_quote:
-                try:
-                    quote = msg["quote"]["text"]
-                    quote = f"\n>\n> {quote}\n>\n"
-                except (KeyError, TypeError):
-                    pass
 
-            yield md_path, f"[{date}] {sender}: {quote}{body}"
+def attachment_path(file_name: str) -> str:
+    """Get the relative link to an attachment in the chat's media folder."""
+    return "./media/" + file_name.replace(" ", "%20")
+
+
+def is_image(file_name: str) -> bool:
+    """Check whether an attachment is shown inline as an image."""
+    suffix = Path(file_name).suffix
+    return bool(suffix) and suffix.split(".")[1] in IMAGE_EXTS
+
+
+def message_markdown(msg: Message) -> str:
+    """Format a message as a (possibly multi-line) markdown entry."""
+    body = msg.body
+    for file_name in msg.attachments:
+        if is_image(file_name):
+            body += "!"
+        body += f"[{file_name}]({attachment_path(file_name)})  "
+    if msg.reactions is not None:
+        body += "\n(- " + ", ".join(msg.reactions) + " -)"
+    quote = "" if msg.quote is None else f"\n>\n> {msg.quote}\n>\n"
+    return f"[{msg.date}] {msg.sender}: {quote}{body}"
+
+
+def create_markdown(
+    chat_dir: Path, records: Iterable[Message]
+) -> Iterable[Tuple[Path, str]]:
+    """Output a conversation into a simple text file."""
+    if log:
+        secho(f"\tDoing markdown for: {chat_dir.name}")
+    md_path = chat_dir / "index.md"
+    empty = True
+    for msg in records:
+        empty = False
+        yield md_path, message_markdown(msg)
+    if empty:
+        md_path.write_text("", encoding="utf-8")  # overwrite file if it exists
+
+
+def markdown_records(lines: List[str]) -> List[Message]:
+    """Recover message records from lines of Markdown."""
+    records = []
+    for date, sender, body in lines_to_msgs(lines):
+        # drop the space after the sender and the final newline
+        body = body[1:-1]
+
+        reactions = None
+        m = REACTIONS_MD.search(body)
+        if m:
+            reactions = m.group(1).split(", ") if m.group(1) else []
+            body = body[: m.start()]
+
+        attachments = []
+        m = ATTACHMENTS_MD.search(body)
+        if m:
+            attachments = ATTACHMENT_MD.findall(m.group())
+            body = body[: m.start()]
+
+        quote = None
+        m = QUOTE_MD.match(body)
+        if m:
+            quote = m.group(1)
+            body = body[m.end() :]
+
+        date = date[1:-1].replace(",", "")
+        sender = sender[1:-1]
+        records.append(Message(date, sender, body, quote, reactions, attachments))
+    return records
 
 
 def fix_names(contacts: Contacts) -> Contacts:
@@ -249,8 +391,23 @@ def fix_names(contacts: Contacts) -> Contacts:
     return contacts
 
 
-def create_html(dest: Path, msgs_per_page: int = 100) -> Iterable[Tuple[Path, str]]:
-    """Create HTML version from Markdown input."""
+def index_contacts(contacts: Contacts) -> ContactIndex:
+    """Map conversation ids, numbers and UUIDs to conversation ids.
+
+    Built once per export so senders and reactions can be resolved without
+    scanning every contact for every message.
+    """
+    index: ContactIndex = {}
+    for cid, contact in contacts.items():
+        index[cid] = cid
+        for field in ("number", "uuid"):
+            if contact.get(field):
+                index[contact[field]] = cid
+    return index
+
+
+def copy_css(dest: Path) -> None:
+    """Copy the stylesheet to the output directory."""
     root = Path(__file__).resolve().parents[0]
     css_source = root / "style.css"
     css_dest = dest / "style.css"
@@ -262,124 +419,500 @@ def create_html(dest: Path, msgs_per_page: int = 100) -> Iterable[Tuple[Path, st
             f"You might want to install one manually at {css_dest}."
         )
 
+
+def attachment_html(file_name: str) -> str:
+    """Show an attachment as an image, audio or video player, or a link."""
+    src = attachment_path(file_name)
+    if is_image(file_name):
+        return templates.figure.format(src=src, alt=file_name)
+    if file_name.endswith((".m4a", ".aac")):
+        return templates.audio.format(src=src)
+    if ".mp4" in file_name:
+        return templates.video.format(src=src)
+    return f'<a href="{src}">{file_name}</a>'
+
+
+def message_html(msg: Message, md: markdown.Markdown) -> str:
+    """Render one message record into HTML."""
+    date, time = msg.date.split(" ")
+    quote = "" if msg.quote is None else f"<div class=quote>{msg.quote}</div>"
+
+    # markdown sees the body as it follows the sender (and quote) in index.md,
+    # with a placeholder where each attachment's link would be
+    typed = msg.body.replace("\ue000", "&#xe000;")
+    body = (" " if msg.quote is None else " \n\n") + typed
+    body += "".join(
+        ATTACHMENT_MARK.format(i) + "  " for i in range(len(msg.attachments))
+    )
+    try:
+        body = md.convert(body)
+    except RecursionError:
+        if log:
+            secho(f"Maximum recursion on message {body}, not converted")
+    body = LINK.sub(LINK_HTML, body)
+
+    def attachment(m: "re.Match[str]") -> str:
+        i = int(m.group(1))
+        return (
+            attachment_html(msg.attachments[i])
+            if i < len(msg.attachments)
+            else m.group(0)
+        )
+
+    body = ATTACHMENT_HTML.sub(attachment, body)
+
+    return templates.message.format(
+        cl="msg me" if msg.sender == "Me" else "msg",
+        date=date,
+        time=time,
+        sender=msg.sender,
+        quote=quote,
+        body=body,
+        reactions=", ".join(msg.reactions or []).replace(",", ""),
+    )
+
+
+def page_file(page_num: int) -> str:
+    """Get the file name of a page when pages are split into files."""
+    return f"page-{page_num:04}.html"
+
+
+def page_nav(page_num: int, last_page: int, href: Callable[[int], str]) -> str:
+    """Render the PREV/NEXT links for a page."""
+    nav = "<nav>"
+    nav += "<div class=prev>"
+    if page_num != 0:
+        nav += f"<a href={href(page_num - 1)}>PREV</a>"
+    else:
+        nav += "PREV"
+    nav += "</div><div class=next>"
+    if page_num != last_page:
+        nav += f"<a href={href(page_num + 1)}>NEXT</a>"
+    else:
+        nav += "NEXT"
+    nav += "</div></nav>\n"
+    return nav
+
+
+def render_html(
+    name: str,
+    records: List[Message],
+    msgs_per_page: int = 100,
+    first_page: int = 0,
+    on_page: Optional[Callable[[int], None]] = None,
+) -> Iterator[str]:
+    """Render a conversation's records into an HTML page, a piece at a time.
+
+    With first_page, records are the messages from that page on, and the
+    head is left out, to carry on from the end of the page before.
+    on_page is called with each page number before it's rendered.
+    """
+    md = markdown.Markdown()
+    last_page = int((first_page * msgs_per_page + len(records)) / msgs_per_page)
+    if not first_page:
+        yield templates.html_head.format(
+            name=name, first="#pg0", last=f"#pg{last_page}"
+        )
+
+    page_num = first_page
+    for i, msg in enumerate(records):
+        if i % msgs_per_page == 0:
+            nav = "\n"
+            if page_num > 0:
+                nav += "</div>"
+            nav += f"<div class=page id=pg{page_num}>"
+            nav += page_nav(page_num, last_page, lambda n: f"#pg{n}")
+            if on_page:
+                on_page(page_num)
+            yield nav
+            page_num += 1
+
+        yield message_html(msg, md)
+
+    if records:
+        yield "</div>"
+    yield templates.html_foot
+
+
+def render_page(
+    name: str,
+    records: List[Message],
+    page_num: int,
+    last_page: int,
+    md: markdown.Markdown,
+) -> Iterator[str]:
+    """Render one page of a conversation into its own HTML file."""
+    yield templates.html_head.format(
+        name=name, first=page_file(0), last=page_file(last_page)
+    )
+    yield "\n<div class='page split'>" + page_nav(page_num, last_page, page_file)
+    for msg in records:
+        yield message_html(msg, md)
+    yield "</div>"
+    yield templates.page_foot
+
+
+def render_pages(
+    name: str, records: List[Message], msgs_per_page: int = 100, first_page: int = 0
+) -> Iterator[Tuple[str, Iterator[str]]]:
+    """Render a conversation into one HTML file per page.
+
+    Yields (file name, pieces) for each page, and for an index.html that
+    redirects to the first page. With first_page, records are the messages
+    from that page on, and only their pages are yielded, to re-render the
+    end of a conversation.
+    """
     md = markdown.Markdown()
+    last_page = first_page + max(len(records) - 1, 0) // msgs_per_page
+    if not first_page:
+        redirect = templates.redirect.format(name=name, href=page_file(0))
+        yield "index.html", iter([redirect])
+    for page_num in range(first_page, last_page + 1):
+        start = (page_num - first_page) * msgs_per_page
+        page = records[start : start + msgs_per_page]
+        yield page_file(page_num), render_page(name, page, page_num, last_page, md)
+
+
+def html_files(
+    chat_dir: Path,
+    records: List[Message],
+    msgs_per_page: int = 100,
+    split: bool = False,
+    first_page: int = 0,
+) -> Iterator[Tuple[Path, Iterator[str]]]:
+    """Yield each HTML file for a conversation with the pieces to write to it.
+
+    With split and first_page, records are the messages from that page on,
+    and only their pages are yielded, leaving the others as they are.
+    """
+    name = chat_dir.name
+    if not split:
+        yield chat_dir / "index.html", render_html(name, records, msgs_per_page)
+        return
 
-    for sub in dest.iterdir():
-        if sub.is_dir():
-            name = sub.stem
-            if log:
-                secho(f"\tDoing html for {name}")
-            path = sub / "index.md"
-            # touch first
-            open(path, "a", encoding="utf-8")
-            with path.open(encoding="utf-8") as f:
-                lines_raw = f.readlines()
-            lines = lines_to_msgs(lines_raw)
-            last_page = int(len(lines) / msgs_per_page)
-            ht_path = sub / "index.html"
-            ht_content = ""
-
-            page_num = 0
-            for i, msg in enumerate(lines):
-                if i % msgs_per_page == 0:
-                    nav = "\n"
-                    if i > 0:
-                        nav += "</div>"
-                    nav += f"<div class=page id=pg{page_num}>"
-                    nav += "<nav>"
-                    nav += "<div class=prev>"
-                    if page_num != 0:
-                        nav += f"<a href=#pg{page_num-1}>PREV</a>"
-                    else:
-                        nav += "PREV"
-                    nav += "</div><div class=next>"
-                    if page_num != last_page:
-                        nav += f"<a href=#pg{page_num+1}>NEXT</a>"
-                    else:
-                        nav += "NEXT"
-                    nav += "</div></nav>\n"
-                    ht_content += nav
-                    page_num += 1
-
-                date, sender, body = msg
-                sender = sender[1:-1]
-                date, time = date[1:-1].replace(",", "").split(" ")
-
-                # reactions
-                p = re.compile(r"\(- (.*) -\)")
-                m = p.search(body)
-                reactions = m.groups()[0].replace(",", "") if m else ""
-                body = p.sub("", body)
-
-                # quote
-                p = re.compile(r">\n> (.*)\n>", flags=re.DOTALL)
-                m = p.search(body)
-                if m:
-                    quote = m.groups()[0]
-                    quote = f"<div class=quote>{quote}</div>"
-                else:
-                    quote = ""
-                body = p.sub("", body)
+    if not first_page:
+        # pages left over from an earlier, longer export
+        for stale in chat_dir.glob("page-*.html"):
+            stale.unlink()
+    for file_name, chunks in render_pages(name, records, msgs_per_page, first_page):
+        yield chat_dir / file_name, chunks
 
-                try:
-                    body = md.convert(body)
-                except RecursionError:
-                    if log:
-                        secho(f"Maximum recursion on message {body}, not converted")
-
-                # links
-                p = re.compile(r"(https{0,1}://\S*)")
-                template = r"<a href='\1' target='_blank'>\1</a> "
-                body = re.sub(p, template, body)
-
-                # images
-                soup = BeautifulSoup(body, "html.parser")
-                imgs = soup.find_all("img")
-                for im in imgs:
-                    if im.get("src"):
-                        temp = templates.figure.format(src=im["src"], alt=im["alt"])
-                        im.replace_with(BeautifulSoup(temp, "html.parser"))
-
-                # voice notes
-                voices = soup.select("a")
-                p = re.compile(r'a href=".*\.(m4a|aac)"')
-                for v in voices:
-                    if p.search(str(v)):
-                        temp = templates.audio.format(src=v["href"])
-                        v.replace_with(BeautifulSoup(temp, "html.parser"))
-
-                # videos
-                videos = soup.select(r"a[href*=\.mp4]")
-                for v in videos:
-                    temp = templates.video.format(src=v["href"])
-                    v.replace_with(BeautifulSoup(temp, "html.parser"))
-
-                cl = "msg me" if sender == "Me" else "msg"
-                ht_content += templates.message.format(
-                    cl=cl,
-                    date=date,
-                    time=time,
-                    sender=sender,
-                    quote=quote,
-                    body=soup,
-                    reactions=reactions,
+
+def write_html(
+    path: Path,
+    chunks: Iterable[str],
+    pretty: bool = False,
+    buffer_size: int = BUFFER_SIZE,
+) -> None:
+    """Write an HTML page as it's rendered, indenting it if pretty is set."""
+    write_chunks(path, indent_html(chunks) if pretty else chunks, buffer_size)
+
+
+def write_single_html(
+    chat_dir: Path,
+    records: List[Message],
+    msgs_per_page: int = 100,
+    pretty: bool = False,
+    buffer_size: int = BUFFER_SIZE,
+    first_page: int = 0,
+    offset: int = 0,
+) -> Tuple[int, int]:
+    """Write a conversation's HTML to a single index.html.
+
+    Returns the bytes written and where the last page starts in the file.
+    With first_page, records are the messages from that page on, and the
+    file is cut at offset, where that page started, and written from there.
+    """
+    path = chat_dir / "index.html"
+    last_page = first_page + max(len(records) - 1, 0) // msgs_per_page
+    if first_page:
+        with path.open("r+b") as fb:
+            fb.truncate(offset)
+    with path.open(
+        "a" if first_page else "w", encoding="utf-8", buffering=buffer_size
+    ) as f:
+        start = offset
+
+        def mark(page_num: int) -> None:
+            nonlocal start
+            if page_num == last_page:
+                start = f.tell()
+
+        chunks = render_html(chat_dir.name, records, msgs_per_page, first_page, mark)
+        if pretty:
+            # indent as if the head and the page before had been written, one
+            # output piece per input, and drop those
+            context = [templates.html_head, "<div>"] if first_page else []
+            chunks = islice(indent_html(chain(context, chunks)), len(context), None)
+        for chunk in chunks:
+            f.write(chunk)
+    return path.stat().st_size - offset, start
+
+
+def write_chat_html(
+    chat_dir: Path,
+    records: List[Message],
+    msgs_per_page: int = 100,
+    split: bool = False,
+    pretty: bool = False,
+    buffer_size: int = BUFFER_SIZE,
+    after: Optional[LastPage] = None,
+) -> int:
+    """Write a conversation's HTML files, returning the bytes written.
+
+    With after, the last page written earlier, records are added to the
+    end: only that page and any after it are written, and the LAST links
+    before them are updated. The new last page is saved for the next time.
+    """
+    first_page = 0
+    if after:
+        first_page = max(after.messages - 1, 0) // msgs_per_page
+        records = after.records + records
+    total = first_page * msgs_per_page + len(records)
+    last_page = max(total - 1, 0) // msgs_per_page
+    last = LastPage(total, records[(last_page - first_page) * msgs_per_page :])
+
+    written = 0
+    if split:
+        for ht_path, chunks in html_files(
+            chat_dir, records, msgs_per_page, split, first_page
+        ):
+            write_html(ht_path, chunks, pretty, buffer_size)
+            written += ht_path.stat().st_size
+        if last_page != first_page:
+            for page_num in range(first_page):
+                relink_page(
+                    chat_dir / page_file(page_num),
+                    page_file(first_page),
+                    page_file(last_page),
                 )
-            ht_text = templates.html.format(
-                name=name,
-                last_page=last_page,
-                content=ht_content,
-            )
-            ht_text = BeautifulSoup(ht_text, "html.parser").prettify()
-            ht_text = re.compile(r"^(\s*)", re.MULTILINE).sub(r"\1\1\1\1", ht_text)
-            yield ht_path, ht_text
+    else:
+        written, last.offset = write_single_html(
+            chat_dir,
+            records,
+            msgs_per_page,
+            pretty,
+            buffer_size,
+            first_page,
+            after.offset if after and first_page else 0,
+        )
+        if after and first_page:
+            old_link = int(after.messages / msgs_per_page)
+            new_link = int(total / msgs_per_page)
+            if new_link != old_link:
+                last.offset += relink_page(
+                    chat_dir / "index.html", f"#pg{old_link}", f"#pg{new_link}"
+                )
+    last.write(chat_dir)
+    return written
+
+
+def relink_page(path: Path, old_href: str, new_href: str) -> int:
+    """Point the LAST link of a page somewhere else.
+
+    The link is in the head, so unless the new one is a different length
+    it's overwritten in place without rewriting the rest of the page.
+    Returns how much longer the page got.
+    """
+    old = f"href={old_href}".encode()
+    new = f"href={new_href}".encode()
+    with path.open("r+b") as f:
+        head = f.read(1 << 12)
+        at = head.find(old, head.find(b"class=last"))
+        if at < 0:
+            return 0
+        if len(new) == len(old):
+            f.seek(at)
+            f.write(new)
+        else:
+            rest = head[at + len(old) :] + f.read()
+            f.seek(at)
+            f.write(new + rest)
+            f.truncate()
+    return len(new) - len(old)
+
+
+def init_worker(
+    contacts: Contacts,
+    index: ContactIndex,
+    verbose: bool,
+    profile: Optional[Path] = None,
+) -> None:
+    """Give a worker process the contacts, so they're only sent once.
+
+    If profile is set, the worker is profiled too.
+    """
+    global log, worker_contacts, worker_index
+    log = verbose
+    worker_contacts = contacts
+    worker_index = index
+    if profile:
+        profile_worker(profile)
+
+
+def export_chat(
+    cid: str,
+    messages: List[Convo],
+    chat_dir: Path,
+    add_quote: bool = False,
+    html: bool = True,
+    msgs_per_page: int = 100,
+    split: bool = False,
+    pretty: bool = False,
+    buffer_size: int = BUFFER_SIZE,
+    old_md: Optional[Path] = None,
+) -> Tuple[str, str, Optional[str], Dict[str, Stats]]:
+    """Write a conversation's markdown, and its HTML if html is set.
+
+    If old_md is given, the messages in it are merged in first, so the
+    output is only written once.
+
+    This runs in a worker process with --jobs, so instead of printing, it
+    returns the chat name, its log output, the error if it failed and the
+    Stats for each stage, for the main process to show.
+    """
+    out = io.StringIO()
+    stats: Dict[str, Stats] = {}
+    with redirect_stdout(out):
+        try:
+            with timed() as md_stats:
+                records = list(
+                    create_records(
+                        cid, messages, worker_contacts, worker_index, add_quote
+                    )
+                )
+                if not old_md:
+                    write_lines(
+                        create_markdown(chat_dir, records), buffer_size=buffer_size
+                    )
+            if old_md:
+                with timed() as merge_stats:
+                    merged, records = merge_records(records, old_md)
+                merge_stats.messages = len(records)
+                stats["merge"] = merge_stats
+                with timed(md_stats):
+                    write_chunks(chat_dir / "index.md", merged, buffer_size)
+            md_path = chat_dir / "index.md"
+            md_stats.messages = len(records)
+            md_stats.bytes = md_path.stat().st_size if md_path.exists() else 0
+            stats["markdown"] = md_stats
+            if html:
+                if log:
+                    secho(f"\tDoing html for {chat_dir.name}")
+                with timed() as html_stats:
+                    html_stats.bytes = write_chat_html(
+                        chat_dir, records, msgs_per_page, split, pretty, buffer_size
+                    )
+                html_stats.messages = len(records)
+                stats["html"] = html_stats
+        except Exception as e:
+            return chat_dir.name, out.getvalue(), f"{type(e).__name__}: {e}", stats
+    return chat_dir.name, out.getvalue(), None, stats
+
+
+def append_chat(
+    cid: str,
+    messages: List[Convo],
+    chat_dir: Path,
+    add_quote: bool = False,
+    html: bool = True,
+    msgs_per_page: int = 100,
+    split: bool = False,
+    pretty: bool = False,
+    buffer_size: int = BUFFER_SIZE,
+) -> Tuple[str, str, Optional[str], Dict[str, Stats]]:
+    """Add new messages to a conversation exported earlier.
+
+    They're appended to index.md, and the HTML page the earlier export
+    ended on is rendered again with them, from the messages saved with it.
+
+    Returns the same as export_chat.
+    """
+    out = io.StringIO()
+    stats: Dict[str, Stats] = {}
+    md_path = chat_dir / "index.md"
+    with redirect_stdout(out):
+        try:
+            with timed() as md_stats:
+                records = list(
+                    create_records(
+                        cid, messages, worker_contacts, worker_index, add_quote
+                    )
+                )
+                write_chunks(
+                    md_path,
+                    (message_markdown(msg) + "\n" for msg in records),
+                    buffer_size,
+                    append=True,
+                )
+            md_stats.messages = len(records)
+            md_stats.bytes = md_path.stat().st_size
+            stats["markdown"] = md_stats
+            if html:
+                if log:
+                    secho(f"\tAdding {len(records)} messages to {chat_dir.name}")
+                after = LastPage.load(chat_dir)
+                if after is None:
+                    raise FileNotFoundError(f"No {LAST_PAGE} in {chat_dir.name}")
+                with timed() as html_stats:
+                    html_stats.bytes = write_chat_html(
+                        chat_dir,
+                        records,
+                        msgs_per_page,
+                        split,
+                        pretty,
+                        buffer_size,
+                        after,
+                    )
+                html_stats.messages = len(after.records) + len(records)
+                stats["html"] = html_stats
+        except Exception as e:
+            return chat_dir.name, out.getvalue(), f"{type(e).__name__}: {e}", stats
+    return chat_dir.name, out.getvalue(), None, stats
+
+
+def create_html(
+    chat_dir: Path,
+    msgs_per_page: int = 100,
+    split: bool = False,
+    pretty: bool = False,
+    buffer_size: int = BUFFER_SIZE,
+) -> Tuple[str, Stats]:
+    """Create HTML version from Markdown input.
+
+    Only needed for chats copied from an older export; new exports render
+    HTML straight from the message records. Returns the chat name and the
+    Stats for doing it.
+    """
+    with timed() as stats:
+        path = chat_dir / "index.md"
+        # touch first
+        open(path, "a", encoding="utf-8")
+        with path.open(encoding="utf-8") as f:
+            lines_raw = f.readlines()
+        records = markdown_records(lines_raw)
+        stats.bytes = write_chat_html(
+            chat_dir, records, msgs_per_page, split, pretty, buffer_size
+        )
+    stats.messages = len(records)
+    return chat_dir.name, stats
+
+
+def chat_dirs(subs: Iterable[Path]) -> List[Path]:
+    """Sort chat directories by the size of their index.md, largest first."""
+
+    def size(sub: Path) -> int:
+        md_path = sub / "index.md"
+        return md_path.stat().st_size if md_path.is_file() else 0
+
+    return sorted(subs, key=size, reverse=True)
 
 
 def lines_to_msgs(lines: List[str]) -> List[List[str]]:
     """Extract messages from lines of Markdown."""
-    p = re.compile(r"^(\[\d{4}-\d{2}-\d{2},{0,1} \d{2}:\d{2}\])(.*?:)(.*\n)")
     msgs = []
     for li in lines:
-        m = p.match(li)
+        m = MESSAGE_MD.match(li)
         if m:
             msgs.append(list(m.groups()))
         else:
@@ -387,8 +920,22 @@ def lines_to_msgs(lines: List[str]) -> List[List[str]]:
     return msgs
 
 
+def print_chats(contacts: Contacts, stats: ChatStats) -> None:
+    """Print chat names with their message counts and date ranges."""
+    chats = [(v["name"], stats.get(k)) for k, v in contacts.items()]
+    chats = sorted((c for c in chats if c[0] is not None), key=lambda c: c[0])
+    width = max((len(name) for name, _ in chats), default=0)
+    for name, stat in chats:
+        if stat:
+            count, first, last = stat
+            dates = f"{timestamp_format(first)} - {timestamp_format(last)}"
+            secho(f"{name:<{width}}  {count:>7} messages  {dates}")
+        else:
+            secho(f"{name:<{width}}        0 messages")
+
+
 def merge_attachments(media_new: Path, media_old: Path) -> None:
-    """Merge new and old attachments directories."""
+    """Merge new and old media store directories."""
     for f in media_old.iterdir():
         if f.is_file():
             try:
@@ -401,63 +948,233 @@ def merge_attachments(media_new: Path, media_old: Path) -> None:
                     )
 
 
-def merge_chat(path_new: Path, path_old: Path) -> None:
-    """Merge new and old chat markdowns."""
-    with path_old.open(encoding="utf-8") as f:
-        old_raw = f.readlines()
-    with path_new.open(encoding="utf-8") as f:
-        new_raw = f.readlines()
+def merge_records(
+    records: List[Message], old_md: Path
+) -> Tuple[List[str], List[Message]]:
+    """Merge a conversation's records with the messages in an older export.
 
+    Returns the merged markdown, a string per message, and the records for
+    it. Messages in both are kept once, with the old ones first. If there's
+    nothing to merge, the records are returned as they are.
+    """
+    new_raw = "".join(message_markdown(msg) + "\n" for msg in records)
+    # split as the old export is, so a line in a message that looks like the
+    # start of another is split off on both sides and still matches
+    new = ["".join(m) for m in lines_to_msgs(io.StringIO(new_raw).readlines())]
     try:
-        a = old_raw[0][:30]
-        b = old_raw[-1][:30]
-        c = new_raw[0][:30]
-        d = new_raw[-1][:30]
-        if log:
-            secho(f"\t\tFirst line old:\t{a}")
-            secho(f"\t\tLast line old:\t{b}")
-            secho(f"\t\tFirst line new:\t{c}")
-            secho(f"\t\tLast line new:\t{d}")
-    except IndexError:
+        with old_md.open(encoding="utf-8") as f:
+            old_raw = f.readlines()
+    except FileNotFoundError:
         if log:
-            secho("\t\tNo new messages for this conversation")
-        return
+            secho(f"\tNo old for {old_md.parent.name}")
+        return new, records
+
+    old = ["".join(m) for m in lines_to_msgs(old_raw)]
+    merged = list(dict.fromkeys(old + new))
+    if merged == new:
+        return new, records
+    if log:
+        secho(f"\tMerged {len(old)} old messages for {old_md.parent.name}")
+    return merged, markdown_records(io.StringIO("".join(merged)).readlines())
 
-    old = lines_to_msgs(old_raw)
-    new = lines_to_msgs(new_raw)
 
-    merged = list(dict.fromkeys([m[0] + m[1] + m[2] for m in old + new]))
+def old_attachments(
+    old_dir: Path, chat_dir: Path, skip: Set[str]
+) -> Iterator[Tuple[Path, Path]]:
+    """Yield (source, destination) for attachments only in an older export."""
+    media_old = old_dir / "media"
+    if not media_old.is_dir():
+        return
+    for f in media_old.iterdir():
+        if f.is_file() and f.name not in skip:
+            yield f, chat_dir / "media" / f.name
 
-    with path_new.open("w", encoding="utf-8") as f:
-        f.writelines(merged)
 
+def copy_old_chats(dest: Path, old: Path, exported: Set[str]) -> List[Path]:
+    """Copy the chats in an older export that weren't exported this time.
 
-def merge_with_old(dest: Path, old: Path) -> None:
-    """Main function for merging new and old."""
+    The shared media store is merged too. Returns the copied chats.
+    """
+    copied = []
     for dir_old in old.iterdir():
-        if dir_old.is_dir():
-            name = dir_old.stem
+        if not dir_old.is_dir() or dir_old.name in exported:
+            continue
+        dir_new = dest / dir_old.name
+        if log:
+            secho(f"\tMerging {dir_old.name}")
+        if dir_old.name == MEDIA_STORE and dir_new.is_dir():
+            merge_attachments(dir_new, dir_old)
+        elif not dir_new.exists():
+            shutil.copytree(dir_old, dir_new)
+            if dir_old.name != MEDIA_STORE:
+                copied.append(dir_new)
+    return copied
+
+
+@contextmanager
+def docker_data(
+    src: Path,
+    docker_image: str,
+    manual: bool = False,
+    chats: Optional[str] = None,
+    include_empty: bool = False,
+    verbose: bool = False,
+    list_chats: bool = False,
+    jobs: int = 1,
+    compress: Compression = Compression.none,
+) -> Iterator[Tuple[ConvoStream, Contacts, ChatStats]]:
+    """Extract data using the Docker container.
+
+    The container's output is read as it's written, so conversations can
+    be exported while later ones are still being extracted.
+    """
+    secho(
+        "Using Docker to extract data, this may take a while the first time!",
+        fg=colors.BLUE,
+    )
+    cmd = ["docker", "run", "--rm", f"--volume={src}:/Signal"]
+    # an environment variable rather than an option, so older images ignore it
+    cmd += [f"--env={COMPRESS_ENV}={compress.value}", docker_image]
+    # any arguments replace the image's default CMD, so always ask for data
+    cmd.append("--print-data")
+    if list_chats:
+        cmd.append("--list-chats")
+    if manual:
+        cmd.append("--manual")
+    if chats:
+        cmd.append(f"--chats={chats}")
+    if include_empty:
+        cmd.append("--include-empty")
+    if verbose:
+        cmd.append("--verbose")
+    if jobs > 1:
+        # so the container sends the largest chats first
+        cmd.append(f"--jobs={jobs}")
+    try:
+        p = subprocess.Popen(  # noqa: S603
+            cmd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+    except FileNotFoundError:
+        secho("Error: using Docker method, but is Docker installed?", fg=colors.RED)
+        secho("Try running this from the command line:\ndocker run hello-world")
+        raise Exit(1)
+    assert p.stdout and p.stderr  # noqa: S101
+
+    # drain the logs as they come so the container never blocks on them
+    logs: Deque[str] = deque(maxlen=100)
+
+    def drain(stream: IO[str]) -> None:
+        for line in stream:
             if log:
-                secho(f"\tMerging {name}")
-            dir_new = dest / name
-            if dir_new.is_dir():
-                merge_attachments(dir_new / "media", dir_old / "media")
-                path_new = dir_new / "index.md"
-                path_old = dir_old / "index.md"
-                try:
-                    merge_chat(path_new, path_old)
-                except FileNotFoundError:
-                    if log:
-                        secho(f"\tNo old for {name}")
-                secho()
-            else:
-                shutil.copytree(dir_old, dir_new)
+                sys.stderr.write(line)
+            logs.append(line)
+
+    stderr = io.TextIOWrapper(p.stderr, encoding="utf-8", errors="replace")
+    drainer = threading.Thread(target=drain, args=(stderr,), daemon=True)
+    drainer.start()
+
+    def fail(message: str, data: str = "") -> NoReturn:
+        if p.poll() is None:
+            p.kill()
+        p.wait()
+        drainer.join()
+        secho(message, fg=colors.RED)
+        if data:
+            secho(data)
+        secho("".join(logs), fg=colors.RED)
+        raise Exit(1)
+
+    def convos(records: ConvoStream) -> ConvoStream:
+        try:
+            yield from records
+        except (ValueError, KeyError, TypeError, OSError, EOFError):
+            fail("Unable to decode data from Docker, see logs below:")
+        if p.wait():
+            fail("Docker process failed, see logs below:")
+
+    try:
+        # the image decides whether to compress, so check what it sent
+        data = open_input(p.stdout)
+        header = data.readline()
+        try:
+            contacts, stats = read_header(header)
+        except (ValueError, KeyError, TypeError, OSError, EOFError):
+            fail("Unable to decode data from Docker, see logs below:", header)
+        yield convos(iter_records(data)), contacts, stats
+    finally:
+        if p.poll() is None:
+            p.kill()
+        p.wait()
+        drainer.join()
+
+
+@contextmanager
+def decrypt_snapshot(
+    src: Path,
+    docker_image: str,
+    manual: bool = False,
+    verbose: bool = False,
+    decrypt_dir: Optional[Path] = None,
+) -> Iterator[Path]:
+    """Decrypt the DB to a plaintext copy using the Docker container.
+
+    The copy is written to a new temporary directory in decrypt_dir (by
+    default in memory if it fits, as with --manual) mounted into the
+    container, and is overwritten and deleted on exit.
+    """
+    secho("Using Docker to decrypt a snapshot of the DB", fg=colors.BLUE)
+    db_file = src / "sql" / "db.sqlite"
+    tmp = Path(
+        tempfile.mkdtemp(
+            prefix="sigexport-", dir=decrypt_dir or default_decrypt_dir(db_file)
+        )
+    )
+    snapshot = tmp / "db.sqlite"
+    try:
+        cmd = ["docker", "run", "--rm", f"--volume={src}:/Signal"]
+        cmd.append(f"--volume={tmp}:/snapshot")
+        if hasattr(os, "getuid"):
+            # so the snapshot is ours to read and delete
+            cmd.append(f"--user={os.getuid()}:{os.getgid()}")
+        cmd += [docker_image, "--snapshot=/snapshot/db.sqlite"]
+        if manual:
+            cmd.append("--manual")
+        if verbose:
+            cmd.append("--verbose")
+        start = time.perf_counter()
+        try:
+            p = subprocess.run(cmd, capture_output=True, text=True)  # noqa: S603
+        except FileNotFoundError:
+            secho("Error: using Docker method, but is Docker installed?", fg=colors.RED)
+            secho("Try running this from the command line:\ndocker run hello-world")
+            raise Exit(1)
+        if p.returncode or not snapshot.is_file():
+            secho("Docker process failed, see logs below:", fg=colors.RED)
+            secho(p.stdout)
+            secho(p.stderr, fg=colors.RED)
+            raise Exit(1)
+        if log:
+            secho(p.stdout)
+            secho(f"Decrypted snapshot in {time.perf_counter() - start:.1f}s")
+        yield snapshot
+    finally:
+        for f in tmp.iterdir():
+            secure_delete(f)
+        tmp.rmdir()
 
 
 def main(
     dest: Path = Argument(None),
     source: Optional[Path] = Option(None, help="Path to Signal source database"),
     old: Optional[Path] = Option(None, help="Path to previous export to merge"),
+    incremental: bool = Option(
+        False,
+        "--incremental",
+        help="Only add the messages and attachments that are new since the last "
+        "export to DEST",
+    ),
     overwrite: bool = Option(
         False, "--overwrite", "-o", help="Overwrite existing output"
     ),
@@ -469,6 +1186,12 @@ def main(
         None, help="Comma-separated chat names to include: contact names or group names"
     ),
     html: bool = Option(True, help="Whether to create HTML output"),
+    split_pages: bool = Option(
+        False, "--split-pages", help="Write each HTML page to its own file"
+    ),
+    pretty_html: bool = Option(
+        False, "--pretty-html", help="Indent the HTML output for reading"
+    ),
     list_chats: bool = Option(
         False, "--list-chats", "-l", help="List available chats and exit"
     ),
@@ -478,152 +1201,443 @@ def main(
     manual: bool = Option(
         False, "--manual", "-m", help="Attempt to manually decrypt DB"
     ),
+    plaintext: bool = Option(
+        False,
+        "--plaintext",
+        help="Read a DB that isn't encrypted, like those made by benchmarks.synth",
+    ),
+    decrypt_dir: Optional[Path] = Option(
+        None,
+        "--decrypt-dir",
+        help="Where --manual and --docker-snapshot decrypt the DB to "
+        "(default /dev/shm if it fits)",
+    ),
+    jobs: int = Option(
+        1,
+        "--jobs",
+        "-j",
+        help="Number of threads copying attachments and processes rendering HTML",
+    ),
+    copy_threads: Optional[int] = Option(
+        None,
+        help="Threads copying attachments in the background while chats are "
+        "rendered, or 0 to copy them in turn [default: --jobs, or 0 with one CPU]",
+    ),
+    link_mode: LinkMode = Option(
+        LinkMode.copy,
+        help="How to put attachments in the output; falls back to copy per file",
+    ),
+    skip_unchanged: bool = Option(
+        True,
+        "--skip-unchanged/--recopy",
+        help="Skip attachments already in the output with the same size and mtime",
+    ),
+    compare_hash: bool = Option(
+        False, help="Compare contents by hash when skipping unchanged attachments"
+    ),
+    media_store: Optional[StoreKey] = Option(
+        None,
+        help="Keep one copy of each attachment in a shared store, keyed by its "
+        "Signal path or content hash, and link to it from each chat",
+    ),
+    buffer_size: int = Option(
+        BUFFER_SIZE, help="Buffer size in bytes for writing output files"
+    ),
     verbose: bool = Option(False, "--verbose", "-v"),
+    timings: bool = Option(
+        False,
+        "--timings",
+        help="Print time, CPU, memory and throughput for each stage at the end",
+    ),
+    metrics_file: Optional[Path] = Option(
+        None, help="Write the timings for each stage and chat to this JSON file"
+    ),
     use_docker: bool = Option(
         False, help="Use Docker container for SQLCipher extraction"
     ),
     docker_image: str = Option(None, help="Docker image to use"),
+    docker_snapshot: bool = Option(
+        False,
+        help="With Docker, decrypt the DB to a temporary plaintext copy and read "
+        "that, instead of streaming the data out of the container",
+    ),
+    compress: Compression = Option(
+        Compression.none,
+        envvar=COMPRESS_ENV,
+        help="Compression for data sent from the Docker container",
+    ),
     print_data: bool = Option(
         False, help="Print extracted DB data and exit (for use by Docker container)"
     ),
+    snapshot: Optional[Path] = Option(
+        None,
+        help="Write a decrypted copy of the DB here and exit (for use by Docker "
+        "container)",
+    ),
+    profile: Optional[Path] = Option(
+        None, help="Profile the export and write the stats to this file"
+    ),
+    profile_top: int = Option(
+        20, help="Number of functions to show from the profile at the end"
+    ),
     version: Optional[bool] = Option(None, "--version", callback=version_callback),
 ) -> None:
     """Read the Signal directory and output attachments and chat to DEST directory."""
     global log
     log = verbose
 
-    if not any((dest, list_chats, print_data)):
-        secho("Error: Missing argument 'DEST'", fg=colors.RED)
-        raise Exit(code=1)
-
-    if source:
-        src = Path(source).expanduser().absolute()
-    else:
-        src = source_location()
-    source = src / "config.json"
-    db_file = src / "sql" / "db.sqlite"
-
-    # Read sqlcipher key from Signal config file
-    if source.is_file():
-        with open(source, encoding="utf-8") as conf:
-            key = json.loads(conf.read())["key"]
-    else:
-        secho(f"Error: {source} not found in directory {src}")
-        raise Exit(code=1)
+    with profiled(profile, profile_top):
+        if not any((dest, list_chats, print_data, snapshot)):
+            secho("Error: Missing argument 'DEST'", fg=colors.RED)
+            raise Exit(code=1)
 
-    if log:
-        secho(f"Fetching data from {db_file}\n")
+        if source:
+            src = Path(source).expanduser().absolute()
+        else:
+            src = source_location()
+        source = src / "config.json"
+        db_file = src / "sql" / "db.sqlite"
+
+        # Read sqlcipher key from Signal config file
+        key: Optional[str] = None
+        if plaintext:
+            if use_docker:
+                secho("Error: --plaintext can't be used with Docker", fg=colors.RED)
+                raise Exit(code=1)
+        elif source.is_file():
+            with open(source, encoding="utf-8") as conf:
+                key = json.loads(conf.read())["key"]
+        else:
+            secho(f"Error: {source} not found in directory {src}")
+            raise Exit(code=1)
 
-    if not use_docker:
-        try:
-            from pysqlcipher3 import dbapi2 as _  # type: ignore[import] # noqa
-        except Exception:
-            use_docker = True
-
-    if use_docker:
-        if not docker_image:
-            docker_version = __version__.split(".dev")[0]
-            docker_image = f"carderne/sigexport:v{docker_version}"
-        secho(
-            "Using Docker to extract data, this may take a while the first time!",
-            fg=colors.BLUE,
-        )
-        cmd = ["docker", "run", "--rm", f"--volume={src}:/Signal", docker_image]
-        if manual:
-            cmd.append("--manual")
-        if chats:
-            cmd.append(f"--chats={chats}")
-        if include_empty:
-            cmd.append("--include-empty")
-        if verbose:
-            cmd.append("--verbose")
-        try:
-            p = subprocess.run(cmd, capture_output=True, text=True, check=True)
-            docker_logs_1, data_raw, docker_logs_2 = p.stdout.split(DATA_DELIM)
-            data = json.loads(data_raw)
+        # --manual decrypts with the sqlcipher CLI, and --plaintext needs no
+        # decrypting, so neither needs pysqlcipher3
+        if not use_docker and not manual and not plaintext:
+            try:
+                from pysqlcipher3 import dbapi2 as _  # type: ignore[import] # noqa
+            except Exception:
+                use_docker = True
+
+        if incremental:
+            if old:
+                secho("Error: --incremental can't be used with --old", fg=colors.RED)
+                raise Exit(code=1)
+            # new messages are found by querying the DB, so it has to be local
+            docker_snapshot = True
+
+        # chats are exported on a pool of processes, so start the biggest first
+        largest_first = jobs > 1
+        metrics = Metrics()
+        # in-process work is already covered by the profiler running here
+        worker_profile = profile if jobs > 1 else None
+
+        def show_metrics() -> None:
+            if timings:
+                metrics.print()
+            if metrics_file:
+                metrics.write(metrics_file)
+
+        with ExitStack() as stack:
+            if print_data:
+                # stdout carries the data, so everything else goes to stderr
+                data_out = stack.enter_context(open_output(sys.stdout.buffer, compress))
+                stack.enter_context(redirect_stdout(sys.stderr))
             if log:
-                secho(docker_logs_1)
-                secho(docker_logs_2)
-            convos, contacts = data["convos"], data["contacts"]
-        except FileNotFoundError:
-            secho("Error: using Docker method, but is Docker installed?", fg=colors.RED)
-            secho("Try running this from the command line:\ndocker run hello-world")
-            raise Exit(1)
-        except subprocess.CalledProcessError as e:
-            secho(f"Docker process failed, see logs below:\n{e}", fg=colors.RED)
-            raise Exit(1)
-        except subprocess.TimeoutExpired:
-            secho("Docker process timed out.")
-            raise Exit(1)
-        except json.JSONDecodeError:
-            secho("Unable to decode data from Docker, see logs below:", fg=colors.RED)
-            secho(p.stdout)
-            secho(p.stderr, fg=colors.RED)
-            raise Exit(1)
-        except (KeyError, TypeError):
-            secho(
-                "Unable to extract convos and contacts from Docker, see data below",
-                fg=colors.RED,
-            )
-            secho(data)
-            raise Exit(1)
-    else:
-        from sigexport.data import fetch_data
-
-        convos, contacts = fetch_data(
-            db_file,
-            key,
-            manual=manual,
-            chats=chats,
-            include_empty=include_empty,
-            log=log,
-        )
-
-    if print_data:
-        data = {"convos": convos, "contacts": contacts}
-        print(DATA_DELIM, json.dumps(data), DATA_DELIM)
-        raise Exit()
-
-    if list_chats:
-        names = sorted(v["name"] for v in contacts.values() if v["name"] is not None)
-        secho(" | ".join(names))
-        raise Exit()
+                secho(f"Fetching data from {db_file}\n")
+
+            if use_docker and not docker_image:
+                docker_version = __version__.split(".dev")[0]
+                docker_image = f"carderne/sigexport:v{docker_version}"
+
+            # unknown when the data comes from Docker, so nothing is incremental
+            last_rowid = 0
+            with timed(metrics.stage("fetch")):
+                if use_docker and not docker_snapshot:
+                    convos, contacts, stats = stack.enter_context(
+                        docker_data(
+                            src,
+                            docker_image,
+                            manual,
+                            chats,
+                            include_empty,
+                            verbose,
+                            list_chats=list_chats,
+                            jobs=jobs,
+                            compress=compress,
+                        )
+                    )
+                else:
+                    db_key: Optional[str] = key
+                    if use_docker:
+                        # read a decrypted copy with sqlite3, so the rest is as local
+                        db_file = stack.enter_context(
+                            decrypt_snapshot(
+                                src, docker_image, manual, verbose, decrypt_dir
+                            )
+                        )
+                        db_key = None
+                    c = stack.enter_context(
+                        open_db(
+                            db_file,
+                            db_key,
+                            manual=manual,
+                            log=log,
+                            decrypt_dir=decrypt_dir,
+                        )
+                    )
+                    if snapshot:
+                        export_plaintext(c, snapshot, manual=manual)
+                        raise Exit()
+                    contacts, convo_ids = fetch_contacts(c, chats=chats, log=log)
+                    last_rowid = fetch_last_rowid(c)
+                    # lazy, so nothing is read from messages until it's iterated
+                    convos = iter_convos(
+                        c,
+                        contacts,
+                        convo_ids,
+                        include_empty,
+                        largest_first=largest_first,
+                        until=last_rowid,
+                    )
+                    stats = fetch_chat_stats(c) if list_chats else {}
 
-    dest = Path(dest).expanduser()
-    if not dest.is_dir() or overwrite:
-        dest.mkdir(parents=True, exist_ok=True)
-    else:
-        secho(
-            f"Output folder '{dest}' already exists, didn't do anything!", fg=colors.RED
-        )
-        secho("Use --overwrite (or -o) to ignore existing directory.", fg=colors.RED)
-        raise Exit()
+            if print_data:
+                if list_chats:
+                    write_records(data_out, contacts, stats=stats)
+                else:
+                    write_records(data_out, contacts, convos)
+                raise Exit()
 
-    contacts = fix_names(contacts)
+            if list_chats:
+                print_chats(contacts, stats)
+                raise Exit()
 
-    secho("Copying and renaming attachments")
-    for att_src, att_dst in copy_attachments(src, dest, convos, contacts):
-        try:
-            shutil.copy2(att_src, att_dst)
-        except FileNotFoundError:
-            secho(f"No file to copy at {att_src}, skipping!", fg=colors.MAGENTA)
-
-    secho("Creating markdown files")
-    for md_path, md_text in create_markdown(dest, convos, contacts, quote):
-        with md_path.open("a", encoding="utf-8") as md_file:
-            print(md_text, file=md_file)
-    if old:
-        secho(f"Merging old at {old} into output directory")
-        secho("No existing files will be deleted or overwritten!")
-        merge_with_old(dest, Path(old))
-    if html:
-        secho("Creating HTML files")
-        if paginate <= 0:
-            paginate = int(1e20)
-        for ht_path, ht_text in create_html(dest, msgs_per_page=paginate):
-            with ht_path.open("w", encoding="utf-8") as ht_file:
-                print(ht_text, file=ht_file)
-    secho("Done!", fg=colors.GREEN)
+            dest = Path(dest).expanduser()
+            if not dest.is_dir() or overwrite or incremental:
+                dest.mkdir(parents=True, exist_ok=True)
+            else:
+                secho(
+                    f"Output folder '{dest}' already exists, didn't do anything!",
+                    fg=colors.RED,
+                )
+                secho(
+                    "Use --overwrite (or -o) to ignore existing directory.",
+                    fg=colors.RED,
+                )
+                raise Exit()
+
+            contacts = fix_names(contacts)
+            index = index_contacts(contacts)
+
+            if paginate <= 0:
+                paginate = int(1e20)
+            if html:
+                copy_css(dest)
+
+            # anything that changes how messages are written
+            settings = {
+                "quote": quote,
+                "paginate": paginate,
+                "html": html,
+                "split_pages": split_pages,
+                "pretty_html": pretty_html,
+                "media_store": media_store.value if media_store else None,
+            }
+            manifest = Manifest.load(dest)
+            if manifest and manifest.settings != settings:
+                if incremental:
+                    secho(
+                        f"The export in {dest} used different settings, "
+                        "so exporting everything"
+                    )
+                manifest = None
+            elif incremental and not manifest:
+                secho(f"No manifest in {dest}, so exporting everything")
+            # conversations to add the new messages to
+            appending: Set[str] = set()
+            if incremental and manifest:
+                selected = set(contacts if convo_ids is None else convo_ids)
+                for cid, state in manifest.chats.items():
+                    if cid not in selected:
+                        continue
+                    chat_dir = dest / state.name
+                    if (
+                        state.rowid
+                        and state.name == chat_name(contacts, cid)
+                        and (chat_dir / "index.md").is_file()
+                        and (
+                            not html
+                            or (chat_dir / "index.html").is_file()
+                            and (chat_dir / LAST_PAGE).is_file()
+                        )
+                    ):
+                        appending.add(cid)
+                    else:
+                        # renamed or deleted since, so export it in full
+                        state.rowid = 0
+                convos = iter_new_convos(
+                    c,
+                    contacts,
+                    manifest.since(),
+                    manifest.rowid,
+                    convo_ids,
+                    include_empty,
+                    until=last_rowid,
+                )
+            manifest = manifest or Manifest(settings)
+            # the state of each chat, saved once it's exported
+            pending: DefaultDict[str, Deque[Tuple[str, ChatState]]] = defaultdict(deque)
+
+            failed: List[str] = []
+
+            def report(
+                result: Tuple[str, str, Optional[str], Dict[str, Stats]],
+            ) -> None:
+                name, logs, error, chat_stats = result
+                print(logs, end="")
+                if error:
+                    secho(f"Failed to export {name}: {error}", fg=colors.RED)
+                    failed.append(name)
+                for stage, stats in chat_stats.items():
+                    metrics.add(name, stage, stats, worker=jobs > 1)
+                cid, state = pending[name].popleft()
+                if error:
+                    state = ChatState(name)
+                else:
+                    state.messages += chat_stats["markdown"].messages
+                manifest.chats[cid] = state
+
+            exported: Set[str] = set()
+            if old:
+                secho(f"Merging old at {old} into output directory")
+                secho("No existing files will be deleted or overwritten!")
+
+            # one conversation at a time (per job), so only those are held in memory
+            secho("Copying attachments and creating markdown and HTML files")
+            store = dest / MEDIA_STORE if media_store else None
+            if copy_threads is None:
+                # copying from the page cache is CPU-bound, so with one CPU a
+                # background thread only competes with rendering
+                copy_threads = jobs if jobs > 1 or cpu_count() > 1 else 0
+            with Copier(
+                copy_threads,
+                link_mode,
+                skip_unchanged,
+                compare_hash,
+                store=store,
+                store_key=media_store or StoreKey.path,
+            ) as copier, Pool(
+                jobs,
+                on_result=report,
+                initializer=init_worker,
+                initargs=(contacts, index, verbose, worker_profile),
+            ) as pool:
+                for cid, messages, fetched in metrics.timed_fetch(convos):
+                    name = chat_name(contacts, cid)
+                    if cid in appending and not messages:
+                        continue
+                    metrics.add(name, "fetch", fetched)
+                    exported.add(name)
+                    with timed() as copied:
+                        att_names = set()
+                        for att_src, att_dst in copy_attachments(
+                            src, dest, cid, messages, contacts
+                        ):
+                            copier.copy(att_src, att_dst, name)
+                            att_names.add(att_dst.name)
+                        if old:
+                            for att_src, att_dst in old_attachments(
+                                old / name, dest / name, att_names
+                            ):
+                                copier.copy(att_src, att_dst, name)
+                                att_names.add(att_dst.name)
+                    metrics.add(name, "copy", copied)
+                    sent_at = max(
+                        (msg.get("sent_at") or 0 for msg in messages), default=0
+                    )
+                    state = ChatState(name, last_rowid, sent_at, 0, sorted(att_names))
+                    pending[name].append((cid, state))
+                    if cid in appending:
+                        appending.remove(cid)
+                        prev = manifest.chats[cid]
+                        state.sent_at = max(prev.sent_at, sent_at)
+                        state.messages = prev.messages
+                        state.attachments = sorted({*prev.attachments, *att_names})
+                        pool.submit(
+                            append_chat,
+                            cid,
+                            messages,
+                            dest / name,
+                            quote,
+                            html,
+                            paginate,
+                            split_pages,
+                            pretty_html,
+                            buffer_size,
+                        )
+                    else:
+                        pool.submit(
+                            export_chat,
+                            cid,
+                            messages,
+                            dest / name,
+                            quote,
+                            html,
+                            paginate,
+                            split_pages,
+                            pretty_html,
+                            buffer_size,
+                            old / name / "index.md" if old else None,
+                        )
+                # the copies still queued once the last chat is submitted
+                with timed(metrics.stage("copy")):
+                    copier.close()
+            secho(f"Attachments: {copier.stats.summary()}")
+            for chat, size in copier.stats.chat_bytes.items():
+                metrics.add(chat, "copy", Stats(bytes=size))
+            if incremental:
+                secho(f"{len(exported)} chats with new messages")
+            # what's left had no new messages, so is up to date
+            for cid in appending:
+                manifest.chats[cid].rowid = last_rowid
+            if not chats:
+                manifest.rowid = last_rowid
+            manifest.write(dest)
+            if failed:
+                secho(f"Failed to export {len(failed)} chats", fg=colors.RED)
+                show_metrics()
+                raise Exit(1)
+
+        if old:
+            with timed(metrics.stage("merge")):
+                copied_chats = copy_old_chats(dest, old, exported)
+            if html and copied_chats:
+                secho("Creating HTML files for chats only in the old export")
+
+                def report_html(result: Tuple[str, Stats]) -> None:
+                    name, stats = result
+                    metrics.add(name, "html", stats, worker=jobs > 1)
+
+                with Pool(
+                    jobs,
+                    on_result=report_html,
+                    initializer=profile_worker if worker_profile else None,
+                    initargs=(worker_profile,),
+                ) as pool:
+                    for chat_dir in chat_dirs(copied_chats):
+                        if log:
+                            secho(f"\tDoing html for {chat_dir.name}")
+                        pool.submit(
+                            create_html,
+                            chat_dir,
+                            paginate,
+                            split_pages,
+                            pretty_html,
+                            buffer_size,
+                        )
+        show_metrics()
+        secho("Done!", fg=colors.GREEN)
 
 
 def cli() -> None:
@@ -0,0 +1,103 @@
+"""Record what an export contains, so a later one can add only what's new."""
+
+import json
+import os
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from sigexport.models import Message
+
+MANIFEST = "manifest.json"
+# bump when the manifest or the output it describes changes incompatibly
+VERSION = 2
+# in each chat's folder, to add messages to the end of its HTML
+LAST_PAGE = ".last-page.json"
+
+
+@dataclass
+class ChatState:
+    """What was exported from one conversation, and to where."""
+
+    name: str
+    # messages up to this rowid are in the export; 0 if it has to be redone
+    rowid: int = 0
+    # of the last message
+    sent_at: int = 0
+    messages: int = 0
+    # file names in the chat's media folder
+    attachments: List[str] = field(default_factory=list)
+
+
+@dataclass
+class Manifest:
+    """The settings of an export and the state of each conversation in it."""
+
+    settings: Dict[str, Any]
+    # conversations not in chats had no messages up to this rowid
+    rowid: int = 0
+    # keyed by conversation id, as names can change
+    chats: Dict[str, ChatState] = field(default_factory=dict)
+
+    @classmethod
+    def load(cls, dest: Path) -> Optional["Manifest"]:
+        """Load the manifest in dest, if there's a readable one."""
+        try:
+            with (dest / MANIFEST).open(encoding="utf-8") as f:
+                data = json.load(f)
+            if data["version"] != VERSION:
+                return None
+            return cls(
+                settings=data["settings"],
+                rowid=data["rowid"],
+                chats={cid: ChatState(**state) for cid, state in data["chats"].items()},
+            )
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def since(self) -> Dict[str, int]:
+        """Get the rowid each conversation is exported up to."""
+        return {cid: state.rowid for cid, state in self.chats.items()}
+
+    def write(self, dest: Path) -> None:
+        """Write the manifest to dest, replacing any earlier one in one step."""
+        path = dest / MANIFEST
+        tmp = path.with_name(path.name + ".tmp")
+        with tmp.open("w", encoding="utf-8") as f:
+            json.dump({"version": VERSION, **asdict(self)}, f, indent=2)
+        os.replace(tmp, path)
+
+
+@dataclass
+class LastPage:
+    """The messages on the last HTML page of a conversation.
+
+    Markdown can't be read back exactly, as a line in a message can look like
+    the start of another, so they're kept here to render the page again with
+    new messages added.
+    """
+
+    # in the whole conversation
+    messages: int
+    records: List[Message]
+    # where the last page starts in index.html, if pages aren't split
+    offset: int = 0
+
+    @classmethod
+    def load(cls, chat_dir: Path) -> Optional["LastPage"]:
+        """Load the last page saved in chat_dir, if there's a readable one."""
+        try:
+            with (chat_dir / LAST_PAGE).open(encoding="utf-8") as f:
+                data = json.load(f)
+            return cls(
+                messages=data["messages"],
+                records=[Message(**msg) for msg in data["records"]],
+                offset=data["offset"],
+            )
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def write(self, chat_dir: Path) -> None:
+        """Save the last page in chat_dir."""
+        with (chat_dir / LAST_PAGE).open("w", encoding="utf-8") as f:
+            json.dump(asdict(self), f)
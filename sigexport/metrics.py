@@ -0,0 +1,205 @@
+"""Measure the time and memory each stage of an export takes."""
+
+import json
+import os
+import sys
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Any, DefaultDict, Dict, Iterator, List, Optional, Tuple
+
+from typer import secho
+
+from .models import Convo, ConvoStream
+
+if sys.platform != "win32":
+    import resource
+
+# stages in the order they're reported
+STAGES = ["fetch", "copy", "markdown", "merge", "html"]
+
+
+def peak_rss() -> Optional[int]:
+    """Get the peak resident memory of this process or its children in bytes."""
+    if sys.platform == "win32":
+        return None
+    peak = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+@dataclass
+class Stats:
+    """Time and throughput of one stage, or of one stage for one chat.
+
+    cpu is the CPU time of the thread doing the work, so copies running on
+    other threads aren't counted against the stage that queued them.
+    """
+
+    wall: float = 0.0
+    cpu: float = 0.0
+    messages: int = 0
+    bytes: int = 0
+    peak_rss: Optional[int] = None
+
+    @property
+    def rate(self) -> float:
+        """Get the messages handled per second."""
+        return self.messages / self.wall if self.wall else 0.0
+
+    def add(self, other: "Stats") -> None:
+        """Add another measurement of the same stage to this one."""
+        self.wall += other.wall
+        self.cpu += other.cpu
+        self.messages += other.messages
+        self.bytes += other.bytes
+        if other.peak_rss is not None:
+            self.peak_rss = max(self.peak_rss or 0, other.peak_rss)
+
+    def as_dict(self) -> Dict[str, Any]:
+        """Get the fields, and the rate, for JSON output."""
+        return {**asdict(self), "msgs_per_sec": self.rate}
+
+
+@contextmanager
+def timed(stats: Optional[Stats] = None) -> Iterator[Stats]:
+    """Add the time spent in the block to stats, or to a new Stats."""
+    stats = stats if stats is not None else Stats()
+    wall, cpu = time.perf_counter(), time.thread_time()
+    try:
+        yield stats
+    finally:
+        stats.wall += time.perf_counter() - wall
+        stats.cpu += time.thread_time() - cpu
+        stats.peak_rss = peak_rss()
+
+
+class Metrics:
+    """Collect Stats per stage and per chat over a whole export.
+
+    With --jobs the stages overlap, and times measured in the workers are
+    summed, so stage times can add up to more than the total. The copy
+    stage is the time spent copying attachments or queueing them for the
+    copy threads, and waiting for the last of them at the end.
+    """
+
+    def __init__(self) -> None:
+        """Start timing the export."""
+        self.stages: DefaultDict[str, Stats] = defaultdict(Stats)
+        self.chats: DefaultDict[str, DefaultDict[str, Stats]] = defaultdict(
+            lambda: defaultdict(Stats)
+        )
+        self._start = time.perf_counter()
+        self._start_cpu = self._cpu()
+        # forkserver workers aren't our children, so they report their own
+        self._worker_cpu = 0.0
+
+    @staticmethod
+    def _cpu() -> float:
+        t = os.times()
+        return t.user + t.system + t.children_user + t.children_system
+
+    def stage(self, name: str) -> Stats:
+        """Get the Stats for a stage, to time a block with."""
+        return self.stages[name]
+
+    def add(self, chat: str, stage: str, stats: Stats, worker: bool = False) -> None:
+        """Add a chat's Stats for a stage, and count them towards the stage.
+
+        Set worker if they were measured in a worker process.
+        """
+        self.chats[chat][stage].add(stats)
+        self.stages[stage].add(stats)
+        if worker:
+            self._worker_cpu += stats.cpu
+
+    def timed_fetch(
+        self, convos: ConvoStream
+    ) -> Iterator[Tuple[str, List[Convo], Stats]]:
+        """Iterate over convos with the Stats for reading each one.
+
+        The caller adds them with the chat's name, which isn't known here.
+        """
+        it = iter(convos)
+        while True:
+            with timed() as fetched:
+                convo = next(it, None)
+            if convo is None:
+                self.stages["fetch"].add(fetched)
+                return
+            cid, messages = convo
+            fetched.messages = len(messages)
+            yield cid, messages, fetched
+
+    def total(self) -> Stats:
+        """Get the totals so far, including the CPU time of workers."""
+        total = Stats(
+            wall=time.perf_counter() - self._start,
+            cpu=self._cpu() - self._start_cpu + self._worker_cpu,
+            messages=self.stages.get("fetch", Stats()).messages,
+            bytes=sum(s.bytes for s in self.stages.values()),
+            peak_rss=peak_rss(),
+        )
+        for s in self.stages.values():
+            if s.peak_rss is not None:
+                total.peak_rss = max(total.peak_rss or 0, s.peak_rss)
+        return total
+
+    def as_dict(self) -> Dict[str, Any]:
+        """Get everything measured, for the metrics file."""
+        return {
+            "total": self.total().as_dict(),
+            "stages": {k: v.as_dict() for k, v in self.stages.items()},
+            "chats": {
+                chat: {k: v.as_dict() for k, v in stages.items()}
+                for chat, stages in self.chats.items()
+            },
+        }
+
+    def write(self, path: Path) -> None:
+        """Write everything measured to path as JSON."""
+        with path.open("w", encoding="utf-8") as f:
+            json.dump(self.as_dict(), f, indent=2)
+
+    def print(self, slowest: int = 10) -> None:
+        """Print a table of the stages and the slowest chats."""
+        header = (
+            f"{'':<24} {'wall s':>8} {'cpu s':>8} {'msgs':>9} {'MB':>8} {'msg/s':>9}"
+        )
+
+        def row(name: str, s: Stats) -> str:
+            return (
+                f"{name[:24]:<24} {s.wall:>8.2f} {s.cpu:>8.2f} {s.messages:>9} "
+                f"{s.bytes / 1e6:>8.1f} {s.rate:>9.0f}"
+            )
+
+        secho("\nTimings")
+        secho(header)
+        names = [s for s in STAGES if s in self.stages]
+        names += [s for s in self.stages if s not in STAGES]
+        for name in names:
+            secho(row(name, self.stages[name]))
+        total = self.total()
+        secho(row("total", total))
+        if total.peak_rss is not None:
+            secho(f"Peak RSS: {total.peak_rss / 1e6:.1f} MB")
+
+        if self.chats:
+
+            def chat_wall(chat: str) -> float:
+                return sum(s.wall for s in self.chats[chat].values())
+
+            secho("\nSlowest chats")
+            secho(header)
+            for chat in sorted(self.chats, key=chat_wall, reverse=True)[:slowest]:
+                chat_total = Stats()
+                for s in self.chats[chat].values():
+                    chat_total.add(s)
+                # each stage handles the same messages
+                chat_total.messages = max(s.messages for s in self.chats[chat].values())
+                secho(row(chat, chat_total))
@@ -1,8 +1,28 @@
 """Package typing."""
 
-from typing import Any, Dict, List
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterable, List, Optional, Tuple
 
 Convo = Dict[str, Any]
 Convos = Dict[str, List[Convo]]
+ConvoStream = Iterable[Tuple[str, List[Convo]]]
 Contact = Dict[str, str]
 Contacts = Dict[str, Contact]
+# conversation ids keyed by conversation id, number and UUID
+ContactIndex = Dict[str, str]
+# message count, first and last sent_at per conversation
+ChatStats = Dict[str, Tuple[int, int, int]]
+
+
+@dataclass
+class Message:
+    """A message as it is written to markdown and HTML."""
+
+    date: str
+    sender: str
+    # markdown text, before any attachments
+    body: str
+    quote: Optional[str] = None
+    reactions: Optional[List[str]] = None
+    # file names in the chat's media folder
+    attachments: List[str] = field(default_factory=list)
@@ -0,0 +1,107 @@
+"""Run CPU-bound work on a pool of processes."""
+
+import multiprocessing
+import os
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from contextlib import suppress
+from types import TracebackType
+from typing import Any, Callable, Optional, Sequence, Set, Type
+
+
+def cpu_count() -> int:
+    """Get the number of CPUs this process can run on."""
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+class Pool:
+    """Call functions in worker processes if jobs > 1, or in this one.
+
+    At most jobs * 2 calls are queued at once, so submitting blocks while the
+    workers are busy instead of pickling every chat up front. Work runs in
+    the order it's submitted, so submit the biggest items first.
+    Results are passed to on_result, and exceptions from the workers are
+    raised, on the calling thread.
+    """
+
+    def __init__(
+        self,
+        jobs: int = 1,
+        on_result: Optional[Callable[[Any], None]] = None,
+        initializer: Optional[Callable[..., None]] = None,
+        initargs: Sequence[Any] = (),
+    ) -> None:
+        """Start the pool, calling initializer(*initargs) in each worker.
+
+        Without workers, initializer is called here instead.
+        """
+        self._on_result = on_result
+        self._executor: Optional[ProcessPoolExecutor] = None
+        if jobs > 1:
+            # forking while the copy threads are running can deadlock the child
+            methods = multiprocessing.get_all_start_methods()
+            method = "forkserver" if "forkserver" in methods else None
+            self._executor = ProcessPoolExecutor(
+                jobs,
+                mp_context=multiprocessing.get_context(method),
+                initializer=initializer,
+                initargs=tuple(initargs),
+            )
+        elif initializer:
+            initializer(*initargs)
+        self._max_pending = jobs * 2
+        self._pending: Set[Future[Any]] = set()
+
+    def submit(self, fn: Callable[..., Any], *args: Any) -> None:  # noqa: ANN401
+        """Call fn(*args), or queue it for a worker."""
+        if not self._executor:
+            self._result(fn(*args))
+            return
+
+        if len(self._pending) >= self._max_pending:
+            done, self._pending = wait(self._pending, return_when=FIRST_COMPLETED)
+            self._collect(done)
+        self._pending.add(self._executor.submit(fn, *args))
+
+    def close(self) -> None:
+        """Wait for queued calls to finish."""
+        if self._executor:
+            pending, self._pending = self._pending, set()
+            try:
+                self._collect(pending)
+            finally:
+                self._executor.shutdown()
+
+    def __enter__(self) -> "Pool":
+        """Use as a context manager that waits for all calls on exit."""
+        return self
+
+    def __exit__(
+        self,
+        exc_type: Optional[Type[BaseException]],
+        exc: Optional[BaseException],
+        tb: Optional[TracebackType],
+    ) -> None:
+        """Wait for queued calls to finish.
+
+        If the block raised, the calls not started yet are cancelled, and
+        errors from the ones still running are dropped so they don't
+        replace its exception.
+        """
+        if not exc_type:
+            self.close()
+            return
+        for future in self._pending:
+            future.cancel()
+        self._pending = {future for future in self._pending if not future.cancelled()}
+        with suppress(Exception):
+            self.close()
+
+    def _collect(self, done: Set["Future[Any]"]) -> None:
+        for future in done:
+            self._result(future.result())
+
+    def _result(self, result: Any) -> None:  # noqa: ANN401
+        if self._on_result:
+            self._on_result(result)
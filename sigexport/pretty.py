@@ -0,0 +1,74 @@
+"""Indent HTML without parsing it."""
+
+import re
+from typing import Iterable, Iterator, List, Optional
+
+TAG = re.compile(r"(<!--.*?-->|<[^>]*>)", flags=re.DOTALL)
+TAG_NAME = re.compile(r"</?([a-zA-Z][a-zA-Z0-9]*)")
+
+# elements that have no closing tag
+VOID = {
+    "area",
+    "base",
+    "br",
+    "col",
+    "embed",
+    "hr",
+    "img",
+    "input",
+    "link",
+    "meta",
+    "source",
+    "track",
+    "wbr",
+}
+# elements whose contents are written as they are
+RAW = {"pre", "script", "style", "textarea"}
+
+
+def indent_html(chunks: Iterable[str], indent: str = "    ") -> Iterator[str]:
+    """Put each tag and run of text on its own line, indented by depth.
+
+    This is a line-based formatter for the well-formed HTML sigexport writes,
+    not a parser: tags are found with a regex and the depth is carried from
+    one chunk to the next, so a page can be indented as it's written.
+    Whitespace inside RAW elements is left alone.
+    """
+    depth = 0
+    raw: Optional[str] = None
+    for chunk in chunks:
+        lines: List[str] = []
+        for token in TAG.split(chunk):
+            if raw:
+                # inside eg <pre>, copy everything up to the closing tag
+                if token.lower() == f"</{raw}>":
+                    raw = None
+                    depth = max(depth - 1, 0)
+                    lines.append(token + "\n")
+                else:
+                    lines.append(token)
+                continue
+
+            if not token.startswith("<"):
+                lines.extend(
+                    indent * depth + line.strip() + "\n"
+                    for line in token.splitlines()
+                    if line.strip()
+                )
+                continue
+
+            m = TAG_NAME.match(token)
+            name = m.group(1).lower() if m else ""
+            if token.startswith("</"):
+                if name not in VOID:
+                    depth = max(depth - 1, 0)
+                lines.append(indent * depth + token + "\n")
+            elif name in RAW:
+                lines.append(indent * depth + token)
+                raw = name
+                depth += 1
+            else:
+                lines.append(indent * depth + token + "\n")
+                if m and name not in VOID and not token.endswith("/>"):
+                    depth += 1
+        yield "".join(lines)
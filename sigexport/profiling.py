@@ -0,0 +1,68 @@
+"""Profile an export with cProfile."""
+
+import cProfile
+import os
+import pstats
+from contextlib import contextmanager
+from multiprocessing import util
+from pathlib import Path
+from typing import Iterator, Optional
+
+from typer import secho
+
+# the profiler of a worker process, kept alive until it exits
+worker_profiler: Optional[cProfile.Profile] = None
+
+
+def worker_file(path: Path, pid: int) -> Path:
+    """Get the file a worker process writes its part of the profile to."""
+    return path.with_name(f"{path.name}.worker-{pid}")
+
+
+def profile_worker(path: Path) -> None:
+    """Profile this worker process until it exits, writing to a file by path."""
+    global worker_profiler
+    worker_profiler = cProfile.Profile()
+    worker_profiler.enable()
+    # run when the worker exits after the pool is shut down
+    util.Finalize(
+        worker_profiler,
+        dump_worker,
+        args=(worker_profiler, path),
+        exitpriority=10,
+    )
+
+
+def dump_worker(profiler: cProfile.Profile, path: Path) -> None:
+    """Stop a worker's profiler and write its stats."""
+    profiler.disable()
+    profiler.dump_stats(worker_file(path, os.getpid()))
+
+
+@contextmanager
+def profiled(path: Optional[Path], top: int = 20) -> Iterator[None]:
+    """Run the block under cProfile if path is set.
+
+    The stats are written to path, along with those written there by any
+    worker processes, and the top functions by their own time are printed.
+    """
+    if not path:
+        yield
+        return
+
+    # left over from a run that was killed
+    for part in path.parent.glob(f"{path.name}.worker-*"):
+        part.unlink()
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        stats = pstats.Stats(profiler)
+        for part in path.parent.glob(f"{path.name}.worker-*"):
+            stats.add(str(part))
+            part.unlink()
+        stats.dump_stats(str(path))
+        secho(f"\nProfile written to {path}, top {top} functions by own time:")
+        stats.sort_stats(pstats.SortKey.TIME).print_stats(top)
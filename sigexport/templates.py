@@ -1,7 +1,6 @@
 """HTML templates."""
 
-html = """
-<!doctype html>
+html_head = """<!doctype html>
 <html lang='en'>
 <head>
     <meta charset='utf-8'>
@@ -10,17 +9,37 @@ html = """
 </head>
 <body>
     <div class=first>
-        <a href=#pg0>FIRST</a>
+        <a href={first}>FIRST</a>
     </div>
     <div class=last>
-        <a href=#pg{last_page}>LAST</a>
+        <a href={last}>LAST</a>
     </div>
-    {content}
+"""
+
+html_foot = """
     <script>if (!document.location.hash) document.location.hash = 'pg0'</script>
 </body>
 </html>
 """
 
+page_foot = """
+</body>
+</html>
+"""
+
+redirect = """<!doctype html>
+<html lang='en'>
+<head>
+    <meta charset='utf-8'>
+    <meta http-equiv=refresh content='0; url={href}'>
+    <title>{name}</title>
+</head>
+<body>
+    <a href='{href}'>{name}</a>
+</body>
+</html>
+"""
+
 message = """
 <div class='{cl}'>
     <span class=date>{date}</span>
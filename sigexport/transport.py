@@ -0,0 +1,105 @@
+"""Stream extracted data from the Docker container to the host.
+
+The container writes newline-delimited JSON: a header record with the
+contacts (and chat stats with --list-chats), then for each conversation a
+record with its id followed by one record per message. The host reads it
+back a line at a time, so it never holds more than one conversation.
+
+The stream can be gzipped. The host asks for that through the
+SIGEXPORT_COMPRESS environment variable, which older images ignore, and
+checks the first bytes of the stream for the gzip magic number, so either
+side can be upgraded first.
+"""
+
+import gzip
+import io
+import json
+from contextlib import contextmanager
+from enum import Enum
+from typing import IO, Iterable, Iterator, List, Optional, Tuple, cast
+
+from sigexport.models import ChatStats, Contacts, Convo, ConvoStream
+
+COMPRESS_ENV = "SIGEXPORT_COMPRESS"
+GZIP_MAGIC = b"\x1f\x8b"
+
+
+class Compression(str, Enum):
+    """How the data stream from the container is compressed."""
+
+    none = "none"
+    gzip = "gzip"
+
+
+@contextmanager
+def open_output(stream: IO[bytes], compression: Compression) -> Iterator[IO[str]]:
+    """Wrap a binary stream to write records to, compressing them if asked.
+
+    The stream is flushed, and left open, on exit.
+    """
+    gz = None
+    if compression == Compression.gzip:
+        # level 1 is much faster than the default and compresses JSON nearly
+        # as well
+        gz = gzip.GzipFile(filename="", fileobj=stream, mode="wb", compresslevel=1)
+    out = io.TextIOWrapper(gz or stream, encoding="utf-8", write_through=True)
+    try:
+        yield out
+    finally:
+        out.detach()
+        if gz:
+            gz.close()
+        stream.flush()
+
+
+def open_input(stream: IO[bytes]) -> IO[str]:
+    """Wrap a binary stream to read records from, decompressing it if needed.
+
+    The stream must be a buffered reader (as Popen pipes are), so the start
+    can be checked without consuming it.
+    """
+    reader = cast(io.BufferedReader, stream)
+    if reader.peek(len(GZIP_MAGIC))[: len(GZIP_MAGIC)] == GZIP_MAGIC:
+        return io.TextIOWrapper(gzip.GzipFile(fileobj=reader), encoding="utf-8")
+    return io.TextIOWrapper(reader, encoding="utf-8")
+
+
+def write_records(
+    out: IO[str],
+    contacts: Contacts,
+    convos: ConvoStream = (),
+    stats: Optional[ChatStats] = None,
+) -> None:
+    """Write contacts and conversations to out as they're read."""
+    header = {"contacts": contacts, "stats": stats}
+    out.write(json.dumps(header) + "\n")
+    for cid, messages in convos:
+        out.write(json.dumps({"convo": cid}) + "\n")
+        for msg in messages:
+            out.write(json.dumps({"message": msg}) + "\n")
+    out.flush()
+
+
+def iter_records(lines: Iterable[str]) -> ConvoStream:
+    """Group the message records after the header into conversations."""
+    cid: Optional[str] = None
+    messages: List[Convo] = []
+    for line in lines:
+        record = json.loads(line)
+        if "convo" in record:
+            if cid is not None:
+                yield cid, messages
+            cid, messages = record["convo"], []
+        else:
+            messages.append(record["message"])
+    if cid is not None:
+        yield cid, messages
+
+
+def read_header(line: str) -> Tuple[Contacts, ChatStats]:
+    """Get the contacts and chat stats from the header record.
+
+    Raises ValueError (or KeyError) if it can't be decoded.
+    """
+    header = json.loads(line)
+    return header["contacts"], header["stats"] or {}
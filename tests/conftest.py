@@ -0,0 +1,29 @@
+from typing import List
+
+import pytest
+
+
+def pytest_addoption(parser: pytest.Parser) -> None:
+    parser.addoption("--perf", action="store_true", help="Run performance tests")
+    parser.addoption(
+        "--perf-update",
+        action="store_true",
+        help="Run performance tests and save the results as the new baseline",
+    )
+    parser.addoption(
+        "--perf-tolerance",
+        type=float,
+        default=0.5,
+        help="Fraction a performance test can regress by before failing",
+    )
+
+
+def pytest_collection_modifyitems(
+    config: pytest.Config, items: List[pytest.Item]
+) -> None:
+    if config.getoption("--perf") or config.getoption("--perf-update"):
+        return
+    skip = pytest.mark.skip(reason="performance test, run with --perf")
+    for item in items:
+        if "perf" in item.keywords:
+            item.add_marker(skip)
@@ -0,0 +1,132 @@
+import json
+import sqlite3
+
+import pytest
+from typer import Exit
+
+from sigexport.data import (
+    fetch_chat_stats,
+    fetch_contacts,
+    fetch_last_rowid,
+    iter_convos,
+    iter_new_convos,
+    open_db,
+)
+
+
+def make_db():
+    db = sqlite3.connect(":memory:")
+    c = db.cursor()
+    c.execute(
+        "CREATE TABLE conversations"
+        "(id, type, e164, name, profileName, members, uuid)"
+    )
+    c.execute(
+        "CREATE TABLE messages"
+        "(rowid INTEGER PRIMARY KEY, json, conversationId, sent_at)"
+    )
+    c.executemany(
+        "INSERT INTO conversations (id, type, e164, name) VALUES (?, ?, ?, ?)",
+        [
+            ("b", "private", "+2", "Bob"),
+            ("a", "private", "+1", "Alice"),
+            ("e", "private", "+3", "Eve"),
+        ],
+    )
+    for cid, sent_at in [("a", 3), ("b", 1), ("a", 2), ("b", 4)]:
+        msg = {"conversationId": cid, "sent_at": sent_at}
+        c.execute(
+            "INSERT INTO messages (json, conversationId, sent_at) VALUES (?, ?, ?)",
+            (json.dumps(msg), cid, sent_at),
+        )
+    return c
+
+
+def test_iter_convos():
+    c = make_db()
+    contacts, convo_ids = fetch_contacts(c)
+    assert convo_ids is None
+    convos = [
+        (cid, [m["sent_at"] for m in msgs])
+        for cid, msgs in iter_convos(c, contacts, convo_ids, include_empty=True)
+    ]
+    assert convos == [("a", [2, 3]), ("b", [1, 4]), ("e", [])]
+
+
+def test_iter_convos_chats():
+    c = make_db()
+    contacts, convo_ids = fetch_contacts(c, chats="Bob,Eve")
+    assert convo_ids == ["b", "e"]
+    convos = list(iter_convos(c, contacts, convo_ids))
+    assert [cid for cid, _ in convos] == ["b"]
+
+
+def test_fetch_chat_stats():
+    c = make_db()
+    assert fetch_chat_stats(c) == {"a": (2, 2, 3), "b": (2, 1, 4)}
+
+
+def test_iter_convos_largest_first():
+    c = make_db()
+    c.execute(
+        "INSERT INTO messages (json, conversationId, sent_at) VALUES (?, ?, ?)",
+        (json.dumps({"sent_at": 0}), "b", 0),
+    )
+    contacts, convo_ids = fetch_contacts(c)
+    convos = [
+        (cid, [m["sent_at"] for m in msgs])
+        for cid, msgs in iter_convos(c, contacts, convo_ids, largest_first=True)
+    ]
+    assert convos == [("b", [0, 1, 4]), ("a", [2, 3])]
+
+
+def test_iter_new_convos():
+    c = make_db()
+    for cid, sent_at in [("a", 5), ("b", 6)]:
+        c.execute(
+            "INSERT INTO messages (json, conversationId, sent_at) VALUES (?, ?, ?)",
+            (json.dumps({"sent_at": sent_at}), cid, sent_at),
+        )
+    assert fetch_last_rowid(c) == 6
+    contacts, convo_ids = fetch_contacts(c)
+    # a is up to date to rowid 4, and b only to rowid 2
+    convos = [
+        (cid, [m["sent_at"] for m in msgs])
+        for cid, msgs in iter_new_convos(
+            c, contacts, {"a": 4, "b": 2}, 4, convo_ids, include_empty=True
+        )
+    ]
+    assert convos == [("a", [5]), ("b", [4, 6]), ("e", [])]
+    # b's message at rowid 6 was added after the export started
+    convos = [
+        (cid, [m["sent_at"] for m in msgs])
+        for cid, msgs in iter_new_convos(
+            c, contacts, {"a": 4, "b": 2}, 4, convo_ids, until=5
+        )
+    ]
+    assert convos == [("a", [5]), ("b", [4])]
+    assert list(iter_convos(c, contacts, convo_ids, until=1)) == [
+        ("a", [{"conversationId": "a", "sent_at": 3}])
+    ]
+
+
+def test_open_db_plaintext(tmp_path):
+    db_file = tmp_path / "db.sqlite"
+    db = make_db().connection
+    db.commit()
+    db.execute("VACUUM INTO ?", (str(db_file),))
+    with open_db(db_file, None) as c:
+        contacts, _ = fetch_contacts(c)
+    assert sorted(contacts) == ["a", "b", "e"]
+
+
+def test_open_db_manual_cleanup(tmp_path, monkeypatch):
+    db_file = tmp_path / "db.sqlite"
+    db_file.write_bytes(b"not a database")
+    decrypt_dir = tmp_path / "decrypt"
+    decrypt_dir.mkdir()
+    monkeypatch.setenv("PATH", str(tmp_path))
+    with pytest.raises(Exit):
+        with open_db(db_file, "00", manual=True, decrypt_dir=decrypt_dir):
+            pass
+    assert list(decrypt_dir.iterdir()) == []
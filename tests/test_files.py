@@ -0,0 +1,104 @@
+import pytest
+
+from sigexport.files import Copier, LinkMode, StoreKey, secure_delete, transfer
+
+
+def test_copier(tmp_path):
+    src = tmp_path / "src"
+    dst = tmp_path / "dst"
+    src.mkdir()
+    dst.mkdir()
+    for i in range(20):
+        (src / f"{i}.txt").write_text(str(i))
+
+    with Copier(jobs=4) as copier:
+        for i in range(21):
+            copier.copy(src / f"{i}.txt", dst / f"{i}.txt", f"chat{i % 2}")
+
+    assert copier.stats.copied == 20
+    assert copier.stats.chat_bytes == {"chat0": 15, "chat1": 15}
+    assert copier.stats.missing == [src / "20.txt"]
+    assert sorted(p.name for p in dst.iterdir()) == sorted(
+        p.name for p in src.iterdir()
+    )
+
+
+def test_transfer_hardlink(tmp_path):
+    src = tmp_path / "src.txt"
+    dst = tmp_path / "dst.txt"
+    src.write_text("hello")
+
+    assert transfer(src, dst, LinkMode.hardlink) == ("linked", 0)
+    assert dst.samefile(src)
+    # copying over a previous hardlink must not write through to the source
+    assert transfer(src, dst, LinkMode.copy) == ("copied", 5)
+    assert not dst.samefile(src)
+
+
+@pytest.mark.parametrize("mode", [LinkMode.hardlink, LinkMode.symlink])
+def test_transfer_replaces_copy(tmp_path, mode):
+    src = tmp_path / "src.txt"
+    dst = tmp_path / "dst.txt"
+    src.write_text("hello")
+    transfer(src, dst)
+
+    assert transfer(src, dst, mode) == ("linked", 0)
+    assert dst.samefile(src)
+    assert dst.is_symlink() == (mode == LinkMode.symlink)
+    # again over the link itself, leaving no temporary file
+    assert transfer(src, dst, mode) == ("linked", 0)
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["dst.txt", "src.txt"]
+
+
+@pytest.mark.parametrize("mode", [LinkMode.hardlink, LinkMode.symlink])
+def test_transfer_skip_unchanged_link(tmp_path, mode):
+    src = tmp_path / "src.txt"
+    dst = tmp_path / "dst.txt"
+    src.write_text("hello")
+    transfer(src, dst)
+
+    # a copy with the same size and mtime isn't the link asked for
+    assert transfer(src, dst, mode, skip_unchanged=True) == ("linked", 0)
+    assert transfer(src, dst, mode, skip_unchanged=True) == ("skipped", 0)
+    assert transfer(src, dst, skip_unchanged=True) == ("copied", 5)
+
+
+def test_transfer_skip_unchanged(tmp_path):
+    src = tmp_path / "src.txt"
+    dst = tmp_path / "dst.txt"
+    src.write_text("hello")
+
+    assert transfer(src, dst, skip_unchanged=True) == ("copied", 5)
+    assert transfer(src, dst, skip_unchanged=True) == ("skipped", 0)
+    assert transfer(src, dst, skip_unchanged=True, compare_hash=True) == (
+        "skipped",
+        0,
+    )
+    src.write_text("hello!")
+    assert transfer(src, dst, skip_unchanged=True) == ("copied", 6)
+
+
+def test_copier_store(tmp_path):
+    src = tmp_path / "abcdef"
+    src.write_text("photo")
+    store = tmp_path / "out" / "_media"
+    dsts = [tmp_path / "out" / name / "media" / "photo.jpg" for name in ("A", "B")]
+    for dst in dsts:
+        dst.parent.mkdir(parents=True)
+
+    with Copier(store=store, store_key=StoreKey.hash) as copier:
+        for dst in dsts:
+            copier.copy(src, dst)
+
+    assert copier.stats.copied == 1
+    assert copier.stats.skipped == 1
+    assert len(list(store.iterdir())) == 1
+    for dst in dsts:
+        assert dst.read_text() == "photo"
+
+
+def test_secure_delete(tmp_path):
+    path = tmp_path / "db.sqlite"
+    path.write_bytes(b"secret" * 1000)
+    secure_delete(path)
+    assert not path.exists()
@@ -1,5 +1,6 @@
 import os
 import shutil
+import sys
 import time
 from pathlib import Path
 
@@ -12,116 +13,115 @@ expected_md = """[2022-08-10 19:33] Me: Test message
 [2022-08-10 19:34] Me:   [2022-08-10T19-34-11.986_00_Voice_Message_10-08-2022_15-34.m4a](./media/2022-08-10T19-34-11.986_00_Voice_Message_10-08-2022_15-34.m4a)  
 """  # noqa
 
-expected_html = """<!DOCTYPE html>
-<html lang="en">
+expected_html = """<!doctype html>
+<html lang='en'>
     <head>
-        <meta charset="utf-8"/>
+        <meta charset='utf-8'>
         <title>
             Test
         </title>
-        <link href="../style.css" rel="stylesheet"/>
+        <link rel=stylesheet href='../style.css'>
     </head>
     <body>
-        <div class="first">
-            <a href="#pg0">
+        <div class=first>
+            <a href=#pg0>
                 FIRST
             </a>
         </div>
-        <div class="last">
-            <a href="#pg0">
+        <div class=last>
+            <a href=#pg0>
                 LAST
             </a>
         </div>
-        <div class="page" id="pg0">
+        <div class=page id=pg0>
             <nav>
-                <div class="prev">
+                <div class=prev>
                     PREV
                 </div>
-                <div class="next">
+                <div class=next>
                     NEXT
                 </div>
             </nav>
-            <div class="msg me">
-                <span class="date">
+            <div class='msg me'>
+                <span class=date>
                     2022-08-10
                 </span>
-                <span class="time">
+                <span class=time>
                     19:33
                 </span>
-                <span class="sender">
+                <span class=sender>
                     Me
                 </span>
-                <span class="body">
+                <span class=body>
                     <p>
                         Test message
                     </p>
                 </span>
-                <span class="reaction">
+                <span class=reaction>
                 </span>
             </div>
-            <div class="msg me">
-                <span class="date">
+            <div class='msg me'>
+                <span class=date>
                     2022-08-10
                 </span>
-                <span class="time">
+                <span class=time>
                     19:33
                 </span>
-                <span class="sender">
+                <span class=sender>
                     Me
                 </span>
-                <span class="body">
+                <span class=body>
                     <p>
                         Test image
                         <figure>
                             <label for="2022-08-10T19-33-48.638_00_signal-2022-08-10-153348.jpeg">
-                                <img alt="2022-08-10T19-33-48.638_00_signal-2022-08-10-153348.jpeg" load="lazy" src="./media/2022-08-10T19-33-48.638_00_signal-2022-08-10-153348.jpeg"/>
+                                <img load="lazy" src="./media/2022-08-10T19-33-48.638_00_signal-2022-08-10-153348.jpeg" alt="2022-08-10T19-33-48.638_00_signal-2022-08-10-153348.jpeg">
                             </label>
-                            <input class="modal-state" id="2022-08-10T19-33-48.638_00_signal-2022-08-10-153348.jpeg" type="checkbox"/>
+                            <input class="modal-state" id="2022-08-10T19-33-48.638_00_signal-2022-08-10-153348.jpeg" type="checkbox">
                             <div class="modal">
                                 <label for="2022-08-10T19-33-48.638_00_signal-2022-08-10-153348.jpeg">
                                     <div class="modal-content">
-                                        <img alt="2022-08-10T19-33-48.638_00_signal-2022-08-10-153348.jpeg" class="modal-photo" loading="lazy" src="./media/2022-08-10T19-33-48.638_00_signal-2022-08-10-153348.jpeg"/>
+                                        <img class="modal-photo" loading="lazy" src="./media/2022-08-10T19-33-48.638_00_signal-2022-08-10-153348.jpeg" alt="2022-08-10T19-33-48.638_00_signal-2022-08-10-153348.jpeg">
                                     </div>
                                 </label>
                             </div>
                         </figure>
                     </p>
                 </span>
-                <span class="reaction">
+                <span class=reaction>
                 </span>
             </div>
-            <div class="msg me">
-                <span class="date">
+            <div class='msg me'>
+                <span class=date>
                     2022-08-10
                 </span>
-                <span class="time">
+                <span class=time>
                     19:34
                 </span>
-                <span class="sender">
+                <span class=sender>
                     Me
                 </span>
-                <span class="body">
+                <span class=body>
                     <p>
-                        <audio controls="">
-                            <source src="./media/2022-08-10T19-34-11.986_00_Voice_Message_10-08-2022_15-34.m4a" type="audio/mp4"/>
+                        <audio controls>
+                            <source src="./media/2022-08-10T19-34-11.986_00_Voice_Message_10-08-2022_15-34.m4a" type="audio/mp4">
                         </audio>
                     </p>
                 </span>
-                <span class="reaction">
+                <span class=reaction>
                 </span>
             </div>
-            <script>
-                if (!document.location.hash) document.location.hash = 'pg0'
-            </script>
         </div>
+        <script>if (!document.location.hash) document.location.hash = 'pg0'</script>
     </body>
 </html>
-
 """  # noqa
 
 
 def test_integration():
+    from sigexport.files import LinkMode
     from sigexport.main import main
+    from sigexport.transport import Compression
 
     root = Path(__file__).resolve().parents[0]
     dest = Path("/tmp/signal-test-output")
@@ -131,18 +131,37 @@ def test_integration():
         dest=dest,
         source=source,
         old=None,
+        incremental=False,
         overwrite=True,
         quote=True,
         paginate=100,
         chats=None,
         html=True,
+        split_pages=False,
+        pretty_html=True,
         list_chats=False,
         include_empty=False,
         manual=False,
+        plaintext=False,
+        decrypt_dir=None,
+        jobs=1,
+        copy_threads=None,
+        link_mode=LinkMode.copy,
+        skip_unchanged=True,
+        compare_hash=False,
+        media_store=None,
+        buffer_size=1 << 20,
         verbose=True,
+        timings=False,
+        metrics_file=None,
         use_docker=False,
         docker_image="",
+        docker_snapshot=False,
+        compress=Compression.none,
         print_data=False,
+        snapshot=None,
+        profile=None,
+        profile_top=20,
     )
 
     output_test = dest / "Test"
@@ -167,3 +186,89 @@ def test_integration():
     ).is_file()
 
     shutil.rmtree(dest)
+
+
+def run_cli(args):
+    import typer
+    from typer.testing import CliRunner
+
+    from sigexport.main import main
+
+    app = typer.Typer()
+    app.command()(main)
+    return CliRunner().invoke(app, args)
+
+
+def test_manual_without_pysqlcipher3(tmp_path, monkeypatch):
+    from benchmarks.synth import make_source
+
+    src = make_source(tmp_path / "src", 2, 3)
+    # stands in for the sqlcipher CLI, copying the (already plaintext) DB
+    fake = tmp_path / "bin" / "sqlcipher"
+    fake.parent.mkdir()
+    fake.write_text(
+        f"#!{sys.executable}\n"
+        "import re, sqlite3, sys\n"
+        "out = re.search(r\"ATTACH DATABASE '(.*)' AS\", sys.stdin.read()).group(1)\n"
+        "sqlite3.connect(sys.argv[-1]).execute('VACUUM INTO ?', (out,))\n"
+    )
+    fake.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{fake.parent}{os.pathsep}{os.environ['PATH']}")
+    monkeypatch.setitem(sys.modules, "pysqlcipher3", None)
+
+    dest = tmp_path / "out"
+    result = run_cli([f"--source={src}", "--manual", str(dest)])
+    assert result.exit_code == 0, result.output
+    assert "Docker" not in result.output
+    assert (dest / "Chat0" / "index.md").read_text().count("\n") == 3
+
+
+def test_plaintext(tmp_path, monkeypatch):
+    from benchmarks.synth import make_source
+
+    src = make_source(tmp_path / "src", 2, 3, attachment_ratio=1.0)
+    monkeypatch.setitem(sys.modules, "pysqlcipher3", None)
+
+    dest = tmp_path / "out"
+    result = run_cli([f"--source={src}", "--plaintext", str(dest)])
+    assert result.exit_code == 0, result.output
+    assert (dest / "Chat1" / "index.md").read_text().count("\n") == 3
+    assert len(list((dest / "Chat1" / "media").iterdir())) == 3
+
+
+def test_docker_snapshot_decrypt_dir(tmp_path, monkeypatch):
+    from benchmarks.synth import make_source
+
+    src = make_source(tmp_path / "src", 2, 3)
+    # stands in for docker, copying the (already plaintext) DB to the snapshot
+    # volume and noting where that was
+    fake = tmp_path / "bin" / "docker"
+    fake.parent.mkdir()
+    fake.write_text(
+        f"#!{sys.executable}\n"
+        "import sqlite3, sys\n"
+        "vols = [a[9:].rsplit(':', 1) for a in sys.argv if a[:9] == '--volume=']\n"
+        "vols = {inner: outer for outer, inner in vols}\n"
+        f"open({str(tmp_path / 'used')!r}, 'w').write(vols['/snapshot'])\n"
+        "db = sqlite3.connect(vols['/Signal'] + '/sql/db.sqlite')\n"
+        "db.execute('VACUUM INTO ?', (vols['/snapshot'] + '/db.sqlite',))\n"
+    )
+    fake.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{fake.parent}{os.pathsep}{os.environ['PATH']}")
+    decrypt_dir = tmp_path / "decrypt"
+    decrypt_dir.mkdir()
+
+    dest = tmp_path / "out"
+    result = run_cli(
+        [
+            f"--source={src}",
+            "--use-docker",
+            "--docker-snapshot",
+            f"--decrypt-dir={decrypt_dir}",
+            str(dest),
+        ]
+    )
+    assert result.exit_code == 0, result.output
+    assert Path((tmp_path / "used").read_text()).parent == decrypt_dir
+    assert list(decrypt_dir.iterdir()) == []
+    assert (dest / "Chat0" / "index.md").read_text().count("\n") == 3
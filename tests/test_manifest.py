@@ -0,0 +1,27 @@
+import json
+
+from sigexport.manifest import LAST_PAGE, MANIFEST, ChatState, LastPage, Manifest
+from sigexport.models import Message
+
+
+def test_manifest_round_trip(tmp_path):
+    manifest = Manifest({"paginate": 100}, rowid=7)
+    manifest.chats["c"] = ChatState("Chat", 7, 1_500_000_000_000, 2, ["a.jpg"])
+    manifest.write(tmp_path)
+    assert Manifest.load(tmp_path) == manifest
+    assert manifest.since() == {"c": 7}
+
+
+def test_manifest_unreadable(tmp_path):
+    assert Manifest.load(tmp_path) is None
+    (tmp_path / MANIFEST).write_text(json.dumps({"version": 0}))
+    assert Manifest.load(tmp_path) is None
+
+
+def test_last_page_round_trip(tmp_path):
+    assert LastPage.load(tmp_path) is None
+    records = [Message("2022-08-10 19:34", "Me", "hi", "q", ["A: x"], ["a.jpg"])]
+    last = LastPage(5, records, offset=1234)
+    last.write(tmp_path)
+    assert (tmp_path / LAST_PAGE).is_file()
+    assert LastPage.load(tmp_path) == last
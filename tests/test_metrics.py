@@ -0,0 +1,20 @@
+import json
+
+from sigexport.metrics import Metrics, Stats
+
+
+def test_metrics(tmp_path):
+    metrics = Metrics()
+    convos = [("a", [{"id": 1}, {"id": 2}]), ("b", [{"id": 3}])]
+    for cid, messages, fetched in metrics.timed_fetch(convos):
+        metrics.add(cid, "fetch", fetched)
+        metrics.add(cid, "html", Stats(wall=0.5, messages=len(messages), bytes=10))
+    assert metrics.stages["fetch"].messages == 3
+    assert metrics.stages["html"].rate == 3.0
+    assert metrics.total().bytes == 20
+
+    path = tmp_path / "metrics.json"
+    metrics.write(path)
+    data = json.loads(path.read_text())
+    assert data["chats"]["a"]["html"]["msgs_per_sec"] == 4.0
+    assert data["total"]["messages"] == 3
@@ -0,0 +1,133 @@
+import json
+import re
+import sys
+from collections import Counter
+from pathlib import Path
+from typing import IO, Any, Dict, List
+
+import pytest
+
+from sigexport.main import create_html, export_chat, init_worker
+
+BASELINE = Path(__file__).parent / "perf_baseline.json"
+MESSAGES = 20_000
+CHATS = 40
+
+CONTACTS = {"c": {"name": "Chat", "is_group": False}}
+
+
+def make_messages(n: int) -> List[Dict[str, Any]]:
+    return [
+        {
+            "conversationId": "c",
+            "type": "outgoing" if i % 2 else "incoming",
+            "sent_at": 1_500_000_000_000 + i * 60_000,
+            "body": f"message **{i}** https://signal.org",
+            "quote": {"text": "earlier"} if i % 5 == 0 else None,
+            "attachments": [],
+        }
+        for i in range(n)
+    ]
+
+
+def test_files_opened_once(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    opened: Counter[str] = Counter()
+    path_open = Path.open
+
+    def counting_open(self: Path, *args: Any, **kwargs: Any) -> IO[Any]:  # noqa: ANN401
+        opened[self.name] += 1
+        return path_open(self, *args, **kwargs)
+
+    monkeypatch.setattr(Path, "open", counting_open)
+    init_worker(CONTACTS, {"c": "c"}, False)
+    _, _, error, _ = export_chat(
+        "c", make_messages(500), tmp_path, msgs_per_page=100, split=True
+    )
+    assert error is None
+    assert opened["index.md"] == 1
+    assert opened["page-0004.html"] == 1
+    assert max(opened.values()) == 1
+
+
+def test_regex_not_compiled_per_message(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    compiled: List[str] = []
+    re_compile = re._compile
+
+    def counting_compile(*args: Any, **kwargs: Any) -> re.Pattern:  # noqa: ANN401
+        # count patterns compiled from sigexport, directly or through re.sub etc
+        frame = sys._getframe(1)
+        while frame.f_globals.get("__name__") == "re":
+            frame = frame.f_back
+        if frame.f_globals.get("__name__", "").startswith("sigexport"):
+            compiled.append(args[0])
+        return re_compile(*args, **kwargs)
+
+    monkeypatch.setattr(re, "_compile", counting_compile)
+    init_worker(CONTACTS, {"c": "c"}, False)
+    counts: List[int] = []
+    for n in (10, 200):
+        chat_dir = tmp_path / str(n)
+        chat_dir.mkdir()
+        compiled.clear()
+        export_chat("c", make_messages(n), chat_dir, True, pretty=True)
+        create_html(chat_dir, split=True)
+        # reversed, so they're all merged
+        messages = make_messages(n)[::-1]
+        export_chat("c", messages, chat_dir, True, old_md=chat_dir / "index.md")
+        counts.append(len(compiled))
+    assert counts[0] == counts[1], compiled
+
+
+@pytest.fixture(scope="module")
+def perf_source(tmp_path_factory: pytest.TempPathFactory) -> Path:
+    pytest.importorskip("pysqlcipher3")
+    from benchmarks.synth import make_source
+
+    return make_source(
+        tmp_path_factory.mktemp("perf-source"),
+        CHATS,
+        MESSAGES // CHATS,
+        group_ratio=0.3,
+        group_size=8,
+        attachment_ratio=0.02,
+        reaction_ratio=0.1,
+        quote_ratio=0.05,
+        encrypted=True,
+    )
+
+
+@pytest.mark.perf
+def test_perf(
+    perf_source: Path, tmp_path: Path, request: pytest.FixtureRequest
+) -> None:
+    from benchmarks.bench_stages import export
+
+    first = export(perf_source, tmp_path / "export", [])
+    merged = export(perf_source, tmp_path / "merged", [f"--old={tmp_path / 'export'}"])
+    walls = {s: first["stages"][s]["wall"] for s in ("fetch", "markdown", "html")}
+    walls["merge"] = merged["stages"]["merge"]["wall"]
+    walls["total"] = first["stages"]["total"]["wall"]
+    rates = {stage: round(MESSAGES / wall) for stage, wall in walls.items()}
+    peaks = [run["stages"]["total"]["peak_rss"] for run in (first, merged)]
+    peak = None if None in peaks else max(peaks)
+    results = {"messages": MESSAGES, "msgs_per_sec": rates, "peak_rss": peak}
+
+    if request.config.getoption("--perf-update"):
+        BASELINE.write_text(json.dumps(results, indent=2) + "\n")
+        return
+
+    baseline = json.loads(BASELINE.read_text())
+    tolerance = request.config.getoption("--perf-tolerance")
+    slower = {
+        stage: f"{rate:.0f} msg/s, was {baseline['msgs_per_sec'][stage]:.0f}"
+        for stage, rate in rates.items()
+        if rate < baseline["msgs_per_sec"][stage] * (1 - tolerance)
+    }
+    assert not slower, f"Throughput regressed: {slower}"
+    if peak is not None and baseline["peak_rss"] is not None:
+        assert peak <= baseline["peak_rss"] * (1 + tolerance), (
+            f"Peak RSS regressed: {peak / 1e6:.0f} MB, "
+            f"was {baseline['peak_rss'] / 1e6:.0f} MB"
+        )
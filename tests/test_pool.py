@@ -0,0 +1,21 @@
+import time
+
+import pytest
+
+from sigexport.pool import Pool
+
+
+def test_pool_results():
+    results = []
+    with Pool(2, on_result=results.append) as pool:
+        for _ in range(5):
+            pool.submit(time.sleep, 0)
+    assert results == [None] * 5
+
+
+def test_pool_keeps_exception():
+    with pytest.raises(SystemExit):
+        with Pool(2) as pool:
+            for _ in range(4):
+                pool.submit(time.sleep, 0.2)
+            raise SystemExit(1)
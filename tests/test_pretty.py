@@ -0,0 +1,24 @@
+from sigexport.pretty import indent_html
+
+
+def test_indent_html():
+    chunks = [
+        "<div class=a><p>Hi <em>there</em></p>",
+        "<video><source src=x></source></video><pre>  a\n b</pre></div>",
+    ]
+    expected = """<div class=a>
+    <p>
+        Hi
+        <em>
+            there
+        </em>
+    </p>
+    <video>
+        <source src=x>
+        </source>
+    </video>
+    <pre>  a
+ b</pre>
+</div>
+"""
+    assert "".join(indent_html(chunks)) == expected
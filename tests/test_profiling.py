@@ -0,0 +1,25 @@
+import os
+import pstats
+import subprocess
+import sys
+
+from sigexport.profiling import profiled
+
+WORKER = """
+import cProfile, sys
+from pathlib import Path
+from sigexport.profiling import dump_worker
+profiler = cProfile.Profile()
+profiler.enable()
+dump_worker(profiler, Path(sys.argv[1]))
+"""
+
+
+def test_profiled(tmp_path):
+    path = tmp_path / "export.prof"
+    env = {**os.environ, "PYTHONPATH": os.pathsep.join(sys.path)}
+    with profiled(path, top=1):
+        subprocess.run([sys.executable, "-c", WORKER, str(path)], env=env, check=True)
+    assert list(tmp_path.iterdir()) == [path]
+    funcs = {func for _, _, func in pstats.Stats(str(path)).stats}
+    assert "dump_worker" in funcs
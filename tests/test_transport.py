@@ -0,0 +1,34 @@
+import io
+
+from sigexport.transport import (
+    Compression,
+    iter_records,
+    open_input,
+    open_output,
+    read_header,
+    write_records,
+)
+
+
+def test_records_round_trip():
+    contacts = {"a": {"name": "Alice"}}
+    convos = [("a", [{"body": "hi"}, {"body": "there"}]), ("e", [])]
+    out = io.StringIO()
+    write_records(out, contacts, convos)
+
+    lines = io.StringIO(out.getvalue())
+    assert read_header(lines.readline()) == (contacts, {})
+    assert list(iter_records(lines)) == convos
+
+
+def test_gzip_round_trip():
+    contacts = {"a": {"name": "Alice"}}
+    convos = [("a", [{"body": "hi"}])]
+    raw = io.BytesIO()
+    with open_output(raw, Compression.gzip) as out:
+        write_records(out, contacts, convos)
+    assert raw.getvalue()[:2] == b"\x1f\x8b"
+
+    data = open_input(io.BufferedReader(io.BytesIO(raw.getvalue())))
+    assert read_header(data.readline()) == (contacts, {})
+    assert list(iter_records(data)) == convos
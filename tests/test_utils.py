@@ -1,4 +1,19 @@
-from sigexport.main import source_location, timestamp_format
+import markdown
+import pytest
+
+from sigexport.main import (
+    append_chat,
+    export_chat,
+    html_files,
+    index_contacts,
+    init_worker,
+    merge_records,
+    message_html,
+    sender_id,
+    source_location,
+    timestamp_format,
+)
+from sigexport.models import Message
 
 
 def test_source_location():
@@ -8,3 +23,119 @@ def test_source_location():
 def test_timestamp_format():
     res = timestamp_format(76823746823)
     assert res == "1972-06-08 03:55"
+
+
+def test_index_contacts():
+    contacts = {
+        "c1": {"name": "A", "number": "+1", "uuid": "u1"},
+        "c2": {"name": "B", "number": None, "uuid": "u2"},
+    }
+    index = index_contacts(contacts)
+    assert index == {"c1": "c1", "+1": "c1", "u1": "c1", "c2": "c2", "u2": "c2"}
+
+
+def test_sender_id():
+    index = {"+1": "c1", "u2": "c2"}
+    assert sender_id({"source": "+1", "sourceUuid": "u2"}, index) == "c1"
+    assert sender_id({"source": "+9", "sourceServiceId": "u2"}, index) == "c2"
+    assert sender_id({"source": None, "sourceUuid": "u2"}, index) == "c2"
+    with pytest.raises(KeyError):
+        sender_id({"source": "+9"}, index)
+
+
+def test_html_files_split(tmp_path):
+    (tmp_path / "page-0009.html").touch()
+    records = [Message("2022-08-10 19:33", "Me", f"{i}  ") for i in range(5)]
+    files = {
+        path.name: "".join(chunks)
+        for path, chunks in html_files(tmp_path, records, 2, split=True)
+    }
+    assert not (tmp_path / "page-0009.html").exists()
+    assert list(files) == [
+        "index.html",
+        "page-0000.html",
+        "page-0001.html",
+        "page-0002.html",
+    ]
+    assert "url=page-0000.html" in files["index.html"]
+    assert "<a href=page-0000.html>PREV</a>" in files["page-0001.html"]
+    assert "<a href=page-0002.html>NEXT</a>" in files["page-0001.html"]
+    assert "<a href=page-0002.html>LAST</a>" in files["page-0000.html"]
+    assert files["page-0002.html"].count("class='msg me'") == 1
+
+
+def test_message_html_attachment_marks():
+    md = markdown.Markdown()
+    typed = "sigexportattachment0x \ue0000\ue001"
+    html = message_html(Message("2022-08-10 19:33", "Me", typed), md)
+    assert "sigexportattachment0x &#xe000;0\ue001" in html
+    msg = Message("2022-08-10 19:33", "Me", typed, attachments=["a.jpg"])
+    html = message_html(msg, md)
+    assert "sigexportattachment0x &#xe000;0\ue001" in html
+    assert html.count("<figure>") == 1
+
+
+def test_export_chat_error(tmp_path):
+    init_worker({"c": {"name": "Chat", "is_group": False}}, {"c": "c"}, False)
+    name, _, error, _ = export_chat("c", [{"sent_at": 0}], tmp_path, html=False)
+    assert name == tmp_path.name
+    assert error == "KeyError: 'attachments'"
+
+
+def test_merge_records(tmp_path):
+    old_md = tmp_path / "index.md"
+    old_md.write_text(
+        "[2022-08-10 19:33] Me: old  \n[2022-08-10 19:34] Me: both\nlines  \n"
+    )
+    records = [
+        Message("2022-08-10 19:34", "Me", "both\nlines  "),
+        Message("2022-08-10 19:35", "Me", "new  "),
+    ]
+    merged, merged_records = merge_records(records, old_md)
+    assert merged == [
+        "[2022-08-10 19:33] Me: old  \n",
+        "[2022-08-10 19:34] Me: both\nlines  \n",
+        "[2022-08-10 19:35] Me: new  \n",
+    ]
+    assert [r.body for r in merged_records] == ["old  ", "both\nlines  ", "new  "]
+    assert merge_records(records, tmp_path / "missing.md")[1] is records
+
+
+def test_merge_records_header_line(tmp_path):
+    # a pasted line that looks like the start of a message is split off
+    records = [Message("2022-08-10 19:34", "Me", "re:\n[2022-08-10 19:30] Aya: hi")]
+    old_md = tmp_path / "index.md"
+    merged, _ = merge_records(records, old_md)
+    old_md.write_text("".join(merged))
+    assert merge_records(records, old_md)[0] == merged
+    old_md.write_text("".join(merged))
+    assert merge_records(records, old_md)[0] == merged
+
+
+@pytest.mark.parametrize("split", [False, True])
+@pytest.mark.parametrize("pretty", [False, True])
+@pytest.mark.parametrize("appended_at", [1, 3, 5])
+def test_append_chat(tmp_path, split, pretty, appended_at):
+    init_worker({"c": {"name": "Chat", "is_group": False}}, {"c": "c"}, False)
+    messages = [
+        {
+            "type": "outgoing",
+            "sent_at": i * 60_000,
+            # looks like the start of another message in markdown
+            "body": f"{i}\n[2022-08-10 19:30] Aya: hi",
+            "attachments": [],
+        }
+        for i in range(7)
+    ]
+    full, appended = tmp_path / "full" / "Chat", tmp_path / "appended" / "Chat"
+    full.mkdir(parents=True)
+    appended.mkdir(parents=True)
+    opts = {"msgs_per_page": 2, "split": split, "pretty": pretty}
+    export_chat("c", messages, full, **opts)
+    export_chat("c", messages[:appended_at], appended, **opts)
+    _, _, error, _ = append_chat("c", messages[appended_at:], appended, **opts)
+    assert error is None
+    files = sorted(p.name for p in full.iterdir())
+    assert sorted(p.name for p in appended.iterdir()) == files
+    for name in files:
+        assert (appended / name).read_text() == (full / name).read_text(), name